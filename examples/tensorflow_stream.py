@@ -5,7 +5,8 @@ python, and then encode video output using ffmpeg.
 
 This example uses two ffmpeg processes - one to decode the input video
 and one to encode an output video - while the raw frame processing is
-done in python with numpy.
+done in python with numpy, using ``ffmpeg.pipeline`` to run all three
+stages concurrently.
 
 At a high level, the signal graph looks like this:
 
@@ -30,7 +31,6 @@ import ffmpeg
 import logging
 import numpy as np
 import os
-import subprocess
 import zipfile
 
 
@@ -39,6 +39,8 @@ parser.add_argument('in_filename', help='Input filename')
 parser.add_argument('out_filename', help='Output filename')
 parser.add_argument(
     '--dream', action='store_true', help='Use DeepDream frame processing (requires tensorflow)')
+parser.add_argument(
+    '--workers', type=int, help='Number of frame processing threads (default: number of CPUs)')
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -53,81 +55,34 @@ def get_video_size(filename):
     return width, height
 
 
-def start_ffmpeg_process1(in_filename):
-    logger.info('Starting ffmpeg process1')
-    args = (
-        ffmpeg
-        .input(in_filename)
-        .output('pipe:', format='rawvideo', pix_fmt='rgb24')
-        .compile()
-    )
-    return subprocess.Popen(args, stdout=subprocess.PIPE)
+def process_frame_simple(frame):
+    '''Simple processing example: darken frame.'''
+    return frame * 0.3
 
 
-def start_ffmpeg_process2(out_filename, width, height):
-    logger.info('Starting ffmpeg process2')
-    args = (
+def run(in_filename, out_filename, process_frame, workers=None):
+    width, height = get_video_size(in_filename)
+    out_spec = (
         ffmpeg
         .input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height))
         .output(out_filename, pix_fmt='yuv420p')
         .overwrite_output()
-        .compile()
     )
-    return subprocess.Popen(args, stdin=subprocess.PIPE)
-
-
-def read_frame(process1, width, height):
-    logger.debug('Reading frame')
-
-    # Note: RGB24 == 3 bytes per pixel.
-    frame_size = width * height * 3
-    in_bytes = process1.stdout.read(frame_size)
-    if len(in_bytes) == 0:
-        frame = None
-    else:
-        assert len(in_bytes) == frame_size
-        frame = (
-            np
-            .frombuffer(in_bytes, np.uint8)
-            .reshape([height, width, 3])
-        )
-    return frame
-
-
-def process_frame_simple(frame):
-    '''Simple processing example: darken frame.'''
-    return frame * 0.3
-
-
-def write_frame(process2, frame):
-    logger.debug('Writing frame')
-    process2.stdin.write(
-        frame
-        .astype(np.uint8)
-        .tobytes()
-    )
-
-
-def run(in_filename, out_filename, process_frame):
-    width, height = get_video_size(in_filename)
-    process1 = start_ffmpeg_process1(in_filename)
-    process2 = start_ffmpeg_process2(out_filename, width, height)
-    while True:
-        in_frame = read_frame(process1, width, height)
-        if in_frame is None:
-            logger.info('End of input stream')
-            break
 
+    def process_frame_uint8(frame):
         logger.debug('Processing frame')
-        out_frame = process_frame(in_frame)
-        write_frame(process2, out_frame)
-
-    logger.info('Waiting for ffmpeg process1')
-    process1.wait()
-
-    logger.info('Waiting for ffmpeg process2')
-    process2.stdin.close()
-    process2.wait()
+        return process_frame(frame).astype(np.uint8)
+
+    # Decoding, frame processing and encoding all run concurrently; frames are
+    # processed by a pool of `workers` threads and written back in order.
+    ffmpeg.input(in_filename).pipeline(
+        process_frame_uint8,
+        out_spec,
+        width=width,
+        height=height,
+        workers=workers,
+        as_numpy=True,
+    )
 
     logger.info('Done')
 
@@ -240,9 +195,12 @@ class DeepDream(object):
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    workers = args.workers
     if args.dream:
         import tensorflow as tf
         process_frame = DeepDream().process_frame
+        # The tensorflow session isn't shared between threads.
+        workers = 1
     else:
         process_frame = process_frame_simple
-    run(args.in_filename, args.out_filename, process_frame)
+    run(args.in_filename, args.out_filename, process_frame, workers)
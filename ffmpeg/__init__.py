@@ -1,15 +1,24 @@
 from __future__ import unicode_literals
+import sys
 from . import nodes
+from . import _batch
 from . import _ffmpeg
 from . import _filters
+from . import _frames
+from . import _pipeline
 from . import _probe
 from . import _run
+from . import _transform
 from . import _view
 from .nodes import *
+from ._batch import *
 from ._ffmpeg import *
 from ._filters import *
+from ._frames import *
+from ._pipeline import *
 from ._probe import *
 from ._run import *
+from ._transform import *
 from ._view import *
 
 __all__ = (
@@ -17,6 +26,22 @@ __all__ = (
     + _ffmpeg.__all__
     + _probe.__all__
     + _run.__all__
+    + _transform.__all__
     + _view.__all__
     + _filters.__all__
+    + _frames.__all__
+    + _pipeline.__all__
+    + _batch.__all__
 )
+
+if sys.version_info >= (3, 5):
+    from . import _run_asyncio
+    from ._run_asyncio import *
+
+    __all__ += _run_asyncio.__all__
+
+if sys.version_info >= (3, 6):
+    from . import _frames_asyncio
+    from ._frames_asyncio import *
+
+    __all__ += _frames_asyncio.__all__
@@ -0,0 +1,375 @@
+from __future__ import unicode_literals
+
+from builtins import range
+from ._ffmpeg import input, output
+from ._probe import probe
+from ._run import _get_cpu_budget, _popen, compile, Error
+from collections import namedtuple
+import bisect
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+
+class JobResult(
+    namedtuple('JobResult', ['args', 'returncode', 'out', 'err', 'error', 'wall_time'])
+):
+    """Result of one job run by :meth:`run_many`.
+
+    Attributes:
+        args: the ffmpeg command line.
+        returncode: ffmpeg's exit status, or None if it couldn't be started.
+        out: captured stdout data, if any.
+        err: captured stderr data, if any.
+        error: the exception the job failed with (an :class:`ffmpeg.Error` if
+            ffmpeg returned a non-zero exit code), or None if it succeeded.
+        wall_time: time from starting to reaping ffmpeg, in seconds.
+    """
+
+    __slots__ = ()
+
+
+def _get_pool_size(job_count, max_workers, threads_per_job, cpu_count):
+    """Size the process pool so that ``max_workers * threads_per_job`` doesn't
+    exceed the CPU count, returning ``(max_workers, threads_per_job)``.
+    """
+    if max_workers is None:
+        if threads_per_job is None:
+            max_workers = min(cpu_count, job_count)
+        else:
+            max_workers = min(max(1, cpu_count // threads_per_job), job_count)
+    max_workers = max(1, max_workers)
+    if threads_per_job is None:
+        threads_per_job = max(1, cpu_count // max_workers)
+    return max_workers, threads_per_job
+
+
+def _run_job(args, popen_args):
+    start_time = time.time()
+    returncode = out = err = error = None
+    try:
+        process = _popen(args, *popen_args)
+        out, err = process.communicate()
+        returncode = process.poll()
+        if returncode:
+            error = Error('ffmpeg', out, err)
+    except Exception as e:
+        error = e
+    return JobResult(args, returncode, out, err, error, time.time() - start_time)
+
+
+def _run_jobs(
+    job_queue, get_job_args, popen_args, results, cpu_budget, max_threads, worker_count
+):
+    while True:
+        try:
+            index = job_queue.get_nowait()
+        except queue.Empty:
+            break
+        if cpu_budget is None:
+            results[index] = _run_job(get_job_args(index, None), popen_args)
+            continue
+        # Split the free CPUs between this job and the ones that haven't started
+        # (but no more jobs than can run at once), so jobs get more threads as the
+        # queue drains and the machine stays busy.
+        threads = cpu_budget.acquire(
+            max_threads=max_threads,
+            share=min(job_queue.qsize() + 1, worker_count),
+        )
+        try:
+            results[index] = _run_job(get_job_args(index, threads), popen_args)
+        finally:
+            cpu_budget.release(threads)
+
+
+def run_many(
+    stream_specs,
+    max_workers=None,
+    threads_per_job=None,
+    cmd='ffmpeg',
+    capture_stdout=False,
+    capture_stderr=False,
+    quiet=False,
+    overwrite_output=False,
+    cwd=None,
+    filter_complex_script=None,
+    cpu_budget=None,
+):
+    """Invoke ffmpeg for many node graphs, running up to ``max_workers`` at once.
+
+    All graphs are compiled up-front, so invalid graphs raise before any ffmpeg
+    process is started.  The jobs are then run in order over a pool of at most
+    ``max_workers`` concurrent ffmpeg processes, each limited to
+    ``threads_per_job`` threads (see the ``threads`` argument of :meth:`get_args`),
+    so the pool doesn't oversubscribe the CPU cores.  A failing job doesn't stop
+    the others.
+
+    Args:
+        stream_specs: stream specs to run, e.g. a list of output streams.
+        max_workers: maximum number of concurrent ffmpeg processes; defaults to
+            the number of CPUs divided by ``threads_per_job`` (or the number of
+            jobs, if smaller).
+        threads_per_job: number of threads for each ffmpeg process; defaults to
+            the number of CPUs divided by ``max_workers``.
+        capture_stdout: if True, capture each job's stdout.
+        capture_stderr: if True, capture each job's stderr.
+        quiet: shorthand for setting ``capture_stdout`` and ``capture_stderr``.
+        filter_complex_script: see :meth:`run_async`.
+        cpu_budget: a :class:`CpuBudget` (or a number of CPUs, for the
+            process-wide budget of that size; see :meth:`run`) to schedule the
+            jobs with instead of ``threads_per_job``.  Each job is started once
+            CPUs are free in the budget, and gets an even share of the free CPUs
+            between itself and the jobs still queued (counting no more jobs than
+            ``max_workers``), so the last jobs of a batch are given more threads
+            rather than leaving CPUs idle.
+            ``threads_per_job`` then caps the threads per job, and
+            ``max_workers`` defaults to the size of the budget.
+
+    Returns:
+        A list of :class:`JobResult` tuples, in the same order as
+        ``stream_specs``.
+
+    Example:
+        ::
+
+            results = ffmpeg.run_many(
+                [ffmpeg.input(path).output(path + '.webm') for path in paths],
+                capture_stderr=True,
+            )
+            for path, result in zip(paths, results):
+                if result.error is not None:
+                    print(path, result.returncode, result.err.decode())
+    """
+    stream_specs = list(stream_specs)
+    if cpu_budget is not None:
+        cpu_budget = _get_cpu_budget(cpu_budget)
+        if max_workers is None:
+            max_workers = min(cpu_budget.cpus, len(stream_specs))
+    else:
+        max_workers, threads_per_job = _get_pool_size(
+            len(stream_specs),
+            max_workers,
+            threads_per_job,
+            multiprocessing.cpu_count(),
+        )
+    job_args = [
+        compile(
+            stream_spec,
+            cmd,
+            overwrite_output=overwrite_output,
+            threads=threads_per_job,
+        )
+        for stream_spec in stream_specs
+    ]
+
+    def get_job_args(index, threads):
+        if threads is None:
+            return job_args[index]
+        return compile(
+            stream_specs[index],
+            cmd,
+            overwrite_output=overwrite_output,
+            threads=threads,
+        )
+
+    popen_args = (
+        False,
+        capture_stdout,
+        capture_stderr,
+        quiet,
+        cwd,
+        filter_complex_script,
+    )
+    job_queue = queue.Queue()
+    for index in range(len(job_args)):
+        job_queue.put(index)
+    results = [None] * len(job_args)
+    # Each thread just waits on its current ffmpeg process, so the number of
+    # threads is the number of concurrent processes.
+    worker_count = min(max(1, max_workers), len(job_args))
+    threads = [
+        threading.Thread(
+            target=_run_jobs,
+            args=(
+                job_queue,
+                get_job_args,
+                popen_args,
+                results,
+                cpu_budget,
+                threads_per_job,
+                worker_count,
+            ),
+        )
+        for _ in range(worker_count)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _get_keyframe_times(filename, cmd):
+    """Get the keyframe times of the first video stream, and the file's duration.
+
+    Only packet headers are read (nothing is decoded), which is fast even for long
+    files.
+    """
+    info = probe(
+        filename,
+        cmd=cmd,
+        select_streams='v:0',
+        show_entries='packet=pts_time,flags',
+    )
+    keyframe_times = sorted(
+        float(packet['pts_time'])
+        for packet in info.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time', 'N/A') != 'N/A'
+    )
+    return keyframe_times, float(info['format'].get('duration', 0))
+
+
+def _get_segment_times(keyframe_times, duration, segment_count):
+    """Split ``duration`` into up to ``segment_count`` roughly equal segments that
+    each start on a keyframe (except the first, which starts at 0), returning
+    their start times.
+    """
+    start_times = [0]
+    for index in range(1, segment_count):
+        target = duration * index / segment_count
+        # Use whichever keyframe is nearest to the ideal start time.
+        keyframe_index = bisect.bisect_left(keyframe_times, target)
+        candidates = keyframe_times[max(0, keyframe_index - 1) : keyframe_index + 1]
+        if not candidates:
+            break
+        start_time = min(
+            candidates, key=lambda keyframe_time: abs(keyframe_time - target)
+        )
+        if start_time > start_times[-1]:
+            start_times.append(start_time)
+    return start_times
+
+
+def _escape_concat_path(path):
+    return "'{}'".format(path.replace("'", "'\\''"))
+
+
+def parallel_transcode(
+    filename,
+    out_filename,
+    segments=None,
+    max_workers=None,
+    cpu_budget=None,
+    cmd='ffmpeg',
+    probe_cmd='ffprobe',
+    overwrite_output=False,
+    audio_kwargs=None,
+    **kwargs
+):
+    """Transcode a file by splitting it into segments at keyframes, transcoding the
+    segments concurrently, and joining the results losslessly.
+
+    The keyframes of the first video stream are found with :meth:`probe`, and the
+    file is split into up to ``segments`` parts of roughly equal duration, each
+    starting on a keyframe, so every part can be decoded independently.  The video
+    of each part is transcoded with ``input(filename, ss=start,
+    t=duration).output(..., an=None)`` by :meth:`run_many`, and the parts are then
+    joined with the concat demuxer without re-encoding.
+
+    Audio isn't split: encoders such as AAC add priming samples at the start of
+    every stream, which would put a gap at each join and let the audio drift from
+    the video.  Instead, the audio of the whole file is copied (or encoded once,
+    with ``audio_kwargs``) in the final joining step.
+
+    Args:
+        filename: input filename.
+        out_filename: output filename; its extension is also used for the
+            intermediate segment files, so it must be a format that the concat
+            demuxer can read back (e.g. ``.mp4``, ``.mkv`` or ``.ts``).
+        segments: number of segments; defaults to the number of CPUs.
+        max_workers: see :meth:`run_many`.
+        cpu_budget: see :meth:`run_many`.
+        cmd: ffmpeg command.
+        probe_cmd: ffprobe command.
+        overwrite_output: whether to overwrite ``out_filename`` if it exists.
+        audio_kwargs: keyword-arguments passed to :meth:`output` for the audio in
+            the final step (e.g. ``{'acodec': 'aac', 'audio_bitrate': '128k'}``);
+            by default the audio is copied as-is.
+        **kwargs: keyword-arguments passed to :meth:`output` for the video of each
+            segment (e.g. ``vcodec='libx264'``).
+
+    Raises:
+        :class:`ffmpeg.Error`: if transcoding any segment, or joining them, fails.
+
+    Example:
+        ::
+
+            ffmpeg.parallel_transcode('in.mp4', 'out.mp4', vcodec='libx264', crf=23)
+    """
+    if segments is None:
+        segments = multiprocessing.cpu_count()
+    keyframe_times, duration = _get_keyframe_times(filename, probe_cmd)
+    start_times = _get_segment_times(keyframe_times, duration, segments)
+    extension = os.path.splitext(out_filename)[1]
+    temp_dir = tempfile.mkdtemp(prefix='ffmpeg-segments-')
+    try:
+        segment_filenames = []
+        stream_specs = []
+        for index, start_time in enumerate(start_times):
+            input_kwargs = {}
+            if start_time > 0:
+                input_kwargs['ss'] = start_time
+            if index + 1 < len(start_times):
+                input_kwargs['t'] = start_times[index + 1] - start_time
+            segment_filename = os.path.join(
+                temp_dir, 'segment{:05d}{}'.format(index, extension)
+            )
+            segment_filenames.append(segment_filename)
+            stream_specs.append(
+                input(filename, **input_kwargs).output(
+                    segment_filename, **dict(kwargs, an=None)
+                )
+            )
+        results = run_many(
+            stream_specs,
+            max_workers=max_workers,
+            cmd=cmd,
+            capture_stdout=True,
+            capture_stderr=True,
+            overwrite_output=True,
+            cpu_budget=cpu_budget,
+        )
+        for result in results:
+            if result.error is not None:
+                raise result.error
+
+        list_filename = os.path.join(temp_dir, 'segments.txt')
+        with open(list_filename, 'w') as f:
+            for segment_filename in segment_filenames:
+                f.write('file {}\n'.format(_escape_concat_path(segment_filename)))
+        if audio_kwargs is None:
+            audio_kwargs = {'acodec': 'copy'}
+        joined = input(list_filename, format='concat', safe=0)
+        # The `?` makes the audio optional, for files without any.
+        output(
+            joined['v'],
+            input(filename)['a?'],
+            out_filename,
+            vcodec='copy',
+            **audio_kwargs
+        ).run(
+            cmd=cmd,
+            capture_stdout=True,
+            capture_stderr=True,
+            overwrite_output=overwrite_output,
+        )
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+__all__ = ['JobResult', 'parallel_transcode', 'run_many']
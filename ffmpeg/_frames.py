@@ -0,0 +1,472 @@
+from __future__ import unicode_literals
+
+from builtins import object
+from ._probe import probe
+from ._run import Error, run_async
+from ._utils import import_numpy
+from .nodes import filter_operator, InputNode, output_operator
+import errno
+import os
+import threading
+
+
+# Packed pixel formats supported by the frame reader/writer, mapped to
+# ``(channels, numpy dtype)``.
+_PIX_FMTS = {
+    'abgr': (4, 'u1'),
+    'argb': (4, 'u1'),
+    'bgr24': (3, 'u1'),
+    'bgra': (4, 'u1'),
+    'gray': (1, 'u1'),
+    'gray16be': (1, '>u2'),
+    'gray16le': (1, '<u2'),
+    'grayf32be': (1, '>f4'),
+    'grayf32le': (1, '<f4'),
+    'rgb24': (3, 'u1'),
+    'rgb48be': (3, '>u2'),
+    'rgb48le': (3, '<u2'),
+    'rgba': (4, 'u1'),
+}
+
+
+def _get_pix_fmt_info(pix_fmt):
+    if pix_fmt not in _PIX_FMTS:
+        raise ValueError(
+            'Unsupported pix_fmt {!r}; expected one of: {}'.format(
+                pix_fmt, ', '.join(sorted(_PIX_FMTS))
+            )
+        )
+    return _PIX_FMTS[pix_fmt]
+
+
+def _get_frame_shape(width, height, pix_fmt):
+    channels, _ = _get_pix_fmt_info(pix_fmt)
+    return (height, width, channels)
+
+
+def _get_frame_size(width, height, pix_fmt):
+    channels, dtype = _get_pix_fmt_info(pix_fmt)
+    return width * height * channels * int(dtype[-1])
+
+
+def _get_numpy_views(buffers, width, height, pix_fmt):
+    numpy = import_numpy()
+    _, dtype = _get_pix_fmt_info(pix_fmt)
+    shape = _get_frame_shape(width, height, pix_fmt)
+    return [numpy.frombuffer(buffer, dtype).reshape(shape) for buffer in buffers]
+
+
+def _get_frame_buffers(width, height, pix_fmt, buffer_count, as_numpy):
+    """Allocate frame buffers, returning ``(views, results)``: ``memoryview``
+    objects to read frames into and the corresponding objects to yield.
+    """
+    frame_size = _get_frame_size(width, height, pix_fmt)
+    buffers = [bytearray(frame_size) for _ in range(buffer_count)]
+    views = [memoryview(buffer) for buffer in buffers]
+    if as_numpy:
+        return views, _get_numpy_views(buffers, width, height, pix_fmt)
+    return views, views
+
+
+def _import_shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError(
+            'failed to import multiprocessing.shared_memory, which requires python '
+            '3.8 or later'
+        )
+    return shared_memory
+
+
+class SharedFrameBuffer(object):
+    """Ring of frame slots in a :mod:`multiprocessing.shared_memory` block.
+
+    Pass it to :meth:`frames` as ``shared_buffer`` to decode frames straight into
+    shared memory; the frames are then identified by slot index, so they can be
+    handed to worker processes without pickling any frame data.  A
+    ``SharedFrameBuffer`` pickles as a reference to the same block, so worker
+    processes can receive it once, e.g. as a pool ``initargs`` entry.
+
+    The process that creates the buffer owns it and unlinks the block on
+    :meth:`close`; frames returned by :meth:`get` must not be used after that.
+
+    Example:
+        ::
+
+            def init_worker(buffer):
+                global shared_buffer
+                shared_buffer = buffer
+
+            def process_frame(index):
+                frame = shared_buffer.get(index, as_numpy=True)
+                return frame.mean()
+
+            with ffmpeg.SharedFrameBuffer(width, height, slot_count=8) as buffer:
+                pool = multiprocessing.Pool(initializer=init_worker, initargs=(buffer,))
+                pending = collections.deque()
+                for index in ffmpeg.input('in.mp4').frames(shared_buffer=buffer):
+                    # Slots are reused in turn, so wait for the oldest frame
+                    # before its slot is read into again.
+                    if len(pending) == len(buffer) - 1:
+                        print(pending.popleft().get())
+                    pending.append(pool.apply_async(process_frame, (index,)))
+                for result in pending:
+                    print(result.get())
+    """
+
+    def __init__(self, width, height, pix_fmt='rgb24', slot_count=2, name=None):
+        shared_memory = _import_shared_memory()
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.frame_size = _get_frame_size(width, height, pix_fmt)
+        if name is None:
+            self.__shm = shared_memory.SharedMemory(
+                create=True, size=self.frame_size * slot_count
+            )
+        else:
+            self.__shm = shared_memory.SharedMemory(name=name)
+        self.__owner = name is None
+        self.name = self.__shm.name
+        self.__buffers = [
+            self.__shm.buf[index * self.frame_size : (index + 1) * self.frame_size]
+            for index in range(slot_count)
+        ]
+
+    def __len__(self):
+        return len(self.__buffers)
+
+    def __reduce__(self):
+        return (
+            SharedFrameBuffer,
+            (self.width, self.height, self.pix_fmt, len(self), self.name),
+        )
+
+    def get(self, index, as_numpy=False):
+        """Get the frame in slot ``index``, as a ``memoryview`` or, if ``as_numpy``
+        is True, a numpy array of shape ``(height, width, channels)``; either way
+        no data is copied.
+        """
+        buffer = self.__buffers[index]
+        if as_numpy:
+            return _get_numpy_views([buffer], self.width, self.height, self.pix_fmt)[0]
+        return buffer
+
+    def close(self):
+        """Detach from the shared memory block, and unlink it if this is the
+        process that created it.  Frames returned by :meth:`get` must have been
+        released (deleted) first.
+        """
+        for buffer in self.__buffers:
+            buffer.release()
+        self.__buffers = []
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _get_video_size(stream):
+    """Probe the size of a stream that comes straight from an input file."""
+    if not isinstance(stream.node, InputNode):
+        raise ValueError(
+            '`width` and `height` must be specified for streams that are not read '
+            'directly from an input'
+        )
+    info = probe(stream.node.kwargs['filename'])
+    video_info = next((s for s in info['streams'] if s['codec_type'] == 'video'), None)
+    if video_info is None:
+        raise ValueError('No video stream found in {!r}'.format(stream.node))
+    return int(video_info['width']), int(video_info['height'])
+
+
+def _readinto_exactly(file, view):
+    """Fill ``view`` from ``file``, returning the number of bytes read; this is
+    only less than ``len(view)`` at end-of-file.
+    """
+    size = len(view)
+    pos = 0
+    while pos < size:
+        count = file.readinto(view[pos:])
+        if not count:
+            break
+        pos += count
+    return pos
+
+
+def _finish_process(process, completed):
+    """Wait for a frame-piping process; kill it first if the caller stopped
+    early, otherwise raise :class:`Error` if it failed.
+    """
+    if not completed and process.poll() is None:
+        process.kill()
+    retcode = process.wait()
+    if completed and retcode:
+        raise Error('ffmpeg', None, None)
+
+
+@filter_operator()
+def frames(
+    stream,
+    pix_fmt='rgb24',
+    width=None,
+    height=None,
+    buffer_count=2,
+    as_numpy=False,
+    shared_buffer=None,
+    cmd='ffmpeg',
+    **kwargs
+):
+    """Decode a video stream and iterate over its raw frames.
+
+    ffmpeg is run with a ``rawvideo`` ``pipe:`` output, and each frame is read
+    directly (``readinto``) into one of ``buffer_count`` preallocated buffers, which
+    are reused in turn; no memory is allocated per frame.
+
+    Args:
+        pix_fmt: packed pixel format of the frames, e.g. ``rgb24``, ``bgr24``,
+            ``rgba`` or ``gray``.
+        width: frame width; if ``width`` and ``height`` are not specified, they
+            are determined with :meth:`probe`, which only works if the stream
+            comes straight from an input file.
+        height: frame height.
+        buffer_count: number of frame buffers to cycle through.  A yielded frame
+            is only valid until ``buffer_count`` more frames have been read, so copy
+            any frame that needs to be kept around for longer.
+        as_numpy: if True, yield ``numpy`` arrays of shape
+            ``(height, width, channels)`` that are views of the frame buffers;
+            otherwise yield ``memoryview`` objects.
+        shared_buffer: a :class:`SharedFrameBuffer` to read frames into, instead
+            of private buffers; its slot indices are yielded rather than frames,
+            and its size, pixel format and slot count override ``width``,
+            ``height``, ``pix_fmt`` and ``buffer_count``.
+        cmd: ffmpeg command.
+        **kwargs: extra keyword-arguments passed to :meth:`output`.
+
+    Raises:
+        :class:`ffmpeg.Error`: if ffmpeg returns a non-zero exit code once all
+            frames have been read.
+
+    Example:
+        ::
+
+            for frame in ffmpeg.input('in.mp4').frames(as_numpy=True):
+                print(frame.mean())
+    """
+    if shared_buffer is not None:
+        pix_fmt = shared_buffer.pix_fmt
+        buffer_count = len(shared_buffer)
+        views = [shared_buffer.get(index) for index in range(buffer_count)]
+        results = list(range(buffer_count))
+    else:
+        if width is None or height is None:
+            width, height = _get_video_size(stream)
+        views, results = _get_frame_buffers(
+            width, height, pix_fmt, buffer_count, as_numpy
+        )
+    frame_size = len(views[0])
+
+    process = run_async(
+        stream.output('pipe:', format='rawvideo', pix_fmt=pix_fmt, an=None, **kwargs),
+        cmd=cmd,
+        pipe_stdout=True,
+    )
+    completed = False
+    try:
+        index = 0
+        while _readinto_exactly(process.stdout, views[index]) == frame_size:
+            yield results[index]
+            index = (index + 1) % buffer_count
+        completed = True
+    finally:
+        process.stdout.close()
+        _finish_process(process, completed)
+
+
+def _as_byte_view(frame):
+    """Get a flat byte ``memoryview`` of a buffer-protocol object (e.g. ``bytes``,
+    ``bytearray`` or a numpy array), copying only if it isn't contiguous.
+    """
+    view = memoryview(frame)
+    if not hasattr(view, 'cast'):
+        # Python 2's memoryview can't be cast, so copy anything but flat bytes.
+        if view.ndim != 1 or view.itemsize != 1 or view.strides != (1,):
+            view = memoryview(view.tobytes())
+        return view
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    return view.cast('B')
+
+
+def _read_stream(stream, outputs, name):
+    outputs[name] = stream.read()
+    stream.close()
+
+
+def _writev(fd, buffers):
+    if hasattr(os, 'writev'):
+        return os.writev(fd, buffers)
+    return os.write(fd, buffers[0])
+
+
+class FrameWriter(object):
+    """Writes raw frames to the stdin of an ffmpeg process; see
+    :meth:`frame_writer`.
+    """
+
+    def __init__(self, process, batch_size=64 * 1024):
+        self.process = process
+        self.batch_size = batch_size
+        self.__fd = process.stdin.fileno()
+        self.__batch = bytearray()
+        self.__output = None
+        # Piped stdout/stderr are read in the background, since ffmpeg would
+        # otherwise block once their pipes fill up, while writes block on stdin.
+        self.__outputs = {}
+        self.__readers = []
+        for name in ['stdout', 'stderr']:
+            stream = getattr(process, name)
+            if stream is not None:
+                reader = threading.Thread(
+                    target=_read_stream, args=(stream, self.__outputs, name)
+                )
+                reader.daemon = True
+                reader.start()
+                self.__readers.append(reader)
+
+    def __wait(self):
+        """Close ffmpeg's stdin (which it sees as end-of-input), wait for it to exit
+        and collect its output.
+        """
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+        for reader in self.__readers:
+            reader.join()
+        self.__output = (self.__outputs.get('stdout'), self.__outputs.get('stderr'))
+
+    def __write_buffers(self, buffers):
+        try:
+            while buffers:
+                count = _writev(self.__fd, buffers)
+                while buffers and count >= len(buffers[0]):
+                    count -= len(buffers[0])
+                    buffers.pop(0)
+                if buffers:
+                    buffers[0] = buffers[0][count:]
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # ffmpeg exited before reading all of its input, which is fine if it
+            # succeeded (e.g. with ``-frames:v``); later frames are then dropped.
+            self.__wait()
+            if self.process.returncode:
+                raise Error('ffmpeg', *self.__output)
+
+    def write(self, frame):
+        """Write a frame, given as any buffer-protocol object.
+
+        Frames smaller than ``batch_size`` are copied into a batch that is written
+        once it fills up; larger frames are written directly from the caller's
+        buffer, together with any pending batch in a single vectored write.  Writes
+        block while ffmpeg's input pipe is full.  If ffmpeg exits successfully
+        before reading all of its input (e.g. with ``-frames:v``), the remaining
+        frames are dropped.
+
+        Raises:
+            :class:`ffmpeg.Error`: if ffmpeg exits with a non-zero exit code
+                before reading all of its input.
+        """
+        if self.__output is not None:
+            return
+        view = _as_byte_view(frame)
+        if len(self.__batch) + len(view) < self.batch_size:
+            self.__batch += view
+        else:
+            buffers = [view]
+            if self.__batch:
+                buffers.insert(0, memoryview(self.__batch))
+            self.__batch = bytearray()
+            self.__write_buffers(buffers)
+
+    def flush(self):
+        """Write any batched frames."""
+        if self.__batch and self.__output is None:
+            buffers = [memoryview(self.__batch)]
+            self.__batch = bytearray()
+            self.__write_buffers(buffers)
+
+    def close(self):
+        """Flush pending frames, close ffmpeg's stdin and wait for it to finish.
+
+        Returns: (out, err) tuple containing captured stdout and stderr data, if
+            ``pipe_stdout``/``pipe_stderr`` were set (they're read in the
+            background while frames are written, so ffmpeg never blocks on them).
+
+        Raises:
+            :class:`ffmpeg.Error`: if ffmpeg returns a non-zero exit code.
+        """
+        try:
+            self.flush()
+        finally:
+            if self.__output is None:
+                self.__wait()
+        out, err = self.__output
+        if self.process.returncode:
+            raise Error('ffmpeg', out, err)
+        return out, err
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+@output_operator()
+def frame_writer(stream_spec, batch_size=64 * 1024, **kwargs):
+    """Start ffmpeg and return a :class:`FrameWriter` that feeds raw frames to it.
+
+    The stream spec should read from a ``pipe:`` input, e.g. with
+    ``format='rawvideo'``, ``pix_fmt`` and ``s`` (size) set.  Frames are passed to
+    ffmpeg directly from any buffer-protocol object (numpy arrays, ``bytearray``,
+    ``memoryview``, ...) without first converting them to ``bytes``.
+
+    Args:
+        batch_size: frames smaller than this many bytes are coalesced into
+            batches of up to this size before being written, to save system
+            calls.
+        **kwargs: keyword-arguments passed to :meth:`run_async` (e.g.
+            ``overwrite_output=True``).
+
+    Example:
+        ::
+
+            writer = (
+                ffmpeg
+                .input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height))
+                .output(out_filename, pix_fmt='yuv420p')
+                .overwrite_output()
+                .frame_writer()
+            )
+            with writer:
+                for frame in frames:
+                    writer.write(frame)
+    """
+    process = run_async(stream_spec, pipe_stdin=True, **kwargs)
+    return FrameWriter(process, batch_size=batch_size)
+
+
+__all__ = ['frame_writer', 'FrameWriter', 'frames', 'SharedFrameBuffer']
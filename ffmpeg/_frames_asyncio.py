@@ -0,0 +1,88 @@
+"""asyncio counterpart of :meth:`frames` (Python 3.6+ only)."""
+from __future__ import unicode_literals
+
+from ._frames import (
+    _get_frame_shape,
+    _get_frame_size,
+    _get_pix_fmt_info,
+    _get_video_size,
+)
+from ._run import Error
+from ._run_asyncio import run_asyncio
+from ._utils import import_numpy
+from .nodes import filter_operator
+import asyncio
+
+
+@filter_operator()
+async def aframes(
+    stream,
+    pix_fmt='rgb24',
+    width=None,
+    height=None,
+    as_numpy=False,
+    cmd='ffmpeg',
+    **kwargs
+):
+    """Decode a video stream and asynchronously iterate over its raw frames.
+
+    This is the asyncio counterpart of :meth:`frames`, and takes the same
+    arguments except ``buffer_count`` and ``shared_buffer``.  ffmpeg is started
+    with :meth:`run_asyncio`, so a single event loop can decode many streams
+    concurrently without a thread per process.  If ``width`` and ``height`` aren't
+    specified, :meth:`probe` is run in the loop's default executor.
+
+    Unlike :meth:`frames`, frames aren't read into reused buffers: asyncio's
+    ``readexactly`` returns a new ``bytes`` object for every frame anyway, so each
+    frame is yielded as a read-only view of that object, without copying it.
+    Frames therefore stay valid after iteration moves on, but can't be modified
+    in-place.
+
+    If iteration stops early, ffmpeg is killed when the iterator is closed (e.g.
+    with ``aclose()``, or by the event loop once the iterator is garbage
+    collected).
+
+    Example:
+        ::
+
+            async for frame in ffmpeg.input('in.mp4').aframes(as_numpy=True):
+                print(frame.mean())
+    """
+    if width is None or height is None:
+        loop = asyncio.get_event_loop()
+        width, height = await loop.run_in_executor(None, _get_video_size, stream)
+    frame_size = _get_frame_size(width, height, pix_fmt)
+    if as_numpy:
+        numpy = import_numpy()
+        _, dtype = _get_pix_fmt_info(pix_fmt)
+        shape = _get_frame_shape(width, height, pix_fmt)
+
+    process = await run_asyncio(
+        stream.output('pipe:', format='rawvideo', pix_fmt=pix_fmt, an=None, **kwargs),
+        cmd=cmd,
+        pipe_stdout=True,
+    )
+    completed = False
+    try:
+        while True:
+            try:
+                data = await process.stdout.readexactly(frame_size)
+            except asyncio.IncompleteReadError:
+                break
+            if as_numpy:
+                yield numpy.frombuffer(data, dtype).reshape(shape)
+            else:
+                yield memoryview(data)
+        completed = True
+    finally:
+        if not completed and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        retcode = await process.wait()
+        if completed and retcode:
+            raise Error('ffmpeg', None, None)
+
+
+__all__ = ['aframes']
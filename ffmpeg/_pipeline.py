@@ -0,0 +1,185 @@
+from __future__ import unicode_literals
+
+from builtins import object, range
+from ._frames import frame_writer, frames
+from .nodes import filter_operator
+import multiprocessing
+import queue
+import threading
+
+
+class _Job(object):
+    """A frame handed to the worker pool, and the result of processing it."""
+
+    __slots__ = ('frame', 'result', 'error', 'done')
+
+    def __init__(self, frame=None, error=None):
+        self.frame = frame
+        self.result = None
+        self.error = error
+        self.done = threading.Event()
+        if error is not None:
+            self.done.set()
+
+
+def _read_frames(frame_iter, slots, jobs, pending, stopped, worker_count):
+    try:
+        while True:
+            slots.acquire()
+            if stopped.is_set():
+                break
+            try:
+                frame = next(frame_iter)
+            except StopIteration:
+                break
+            job = _Job(frame)
+            pending.put(job)
+            jobs.put(job)
+    except Exception as e:
+        pending.put(_Job(error=e))
+    finally:
+        frame_iter.close()
+        pending.put(None)
+        for _ in range(worker_count):
+            jobs.put(None)
+
+
+def _process_frames(process_fn, jobs, stopped):
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if not stopped.is_set():
+            try:
+                job.result = process_fn(job.frame)
+            except Exception as e:
+                job.error = e
+        job.done.set()
+
+
+@filter_operator()
+def pipeline(
+    stream,
+    process_fn,
+    output_spec,
+    pix_fmt='rgb24',
+    width=None,
+    height=None,
+    workers=None,
+    max_in_flight=None,
+    as_numpy=False,
+    cmd='ffmpeg',
+    **kwargs
+):
+    """Decode a video stream, process each frame in python, and encode the results.
+
+    Three stages run concurrently: a reader thread decodes frames (see
+    :meth:`frames`), a pool of ``workers`` threads calls ``process_fn`` on them, and
+    the calling thread writes the results, in their original order, to a second
+    ffmpeg process (see :meth:`frame_writer`).  ``process_fn`` only runs in
+    parallel to the extent that it releases the GIL, as numpy and most machine
+    learning libraries do for heavy operations.
+
+    Args:
+        process_fn: function called with each frame, returning a buffer-protocol
+            object (e.g. a ``uint8`` numpy array) holding the output frame.  It
+            must be thread-safe if ``workers`` is more than 1.  Input frames are
+            reused once their output frame has been written, so ``process_fn``
+            may modify and return them in-place.
+        output_spec: output stream spec that reads raw frames from a ``pipe:``
+            input, e.g. ``ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24',
+            s='{}x{}'.format(width, height)).output('out.mp4')``.
+        pix_fmt: packed pixel format of the decoded frames.
+        width: frame width; see :meth:`frames`.
+        height: frame height.
+        workers: number of ``process_fn`` threads; defaults to the number of CPUs.
+        max_in_flight: maximum number of frames that have been decoded but not yet
+            written, which bounds memory use; defaults to ``2 * workers``.
+        as_numpy: if True, pass frames to ``process_fn`` as numpy arrays;
+            otherwise as ``memoryview`` objects.
+        cmd: ffmpeg command.
+        **kwargs: extra keyword-arguments passed to :meth:`output` for the
+            decoding process.
+
+    Raises:
+        :class:`ffmpeg.Error`: if either ffmpeg process fails.  Exceptions raised
+            by ``process_fn`` are re-raised as-is, after both processes have been
+            stopped.
+
+    Example:
+        ::
+
+            out_spec = (
+                ffmpeg
+                .input('pipe:', format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(width, height))
+                .output(out_filename, pix_fmt='yuv420p')
+                .overwrite_output()
+            )
+            ffmpeg.input(in_filename).pipeline(
+                lambda frame: (frame * 0.3).astype(np.uint8),
+                out_spec,
+                width=width,
+                height=height,
+                as_numpy=True,
+            )
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    # A decoded frame's buffer is reused `max_in_flight` frames later, by which
+    # time its result has been written.
+    frame_iter = frames(
+        stream,
+        pix_fmt=pix_fmt,
+        width=width,
+        height=height,
+        buffer_count=max_in_flight,
+        as_numpy=as_numpy,
+        cmd=cmd,
+        **kwargs
+    )
+    writer = frame_writer(output_spec, cmd=cmd)
+
+    slots = threading.Semaphore(max_in_flight)
+    jobs = queue.Queue()
+    pending = queue.Queue()
+    stopped = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_read_frames,
+            args=(frame_iter, slots, jobs, pending, stopped, workers),
+        )
+    ]
+    threads += [
+        threading.Thread(target=_process_frames, args=(process_fn, jobs, stopped))
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            job = pending.get()
+            if job is None:
+                break
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            writer.write(job.result)
+            job.frame = job.result = None
+            slots.release()
+    except BaseException:
+        stopped.set()
+        slots.release()
+        writer.process.kill()
+        writer.process.wait()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    writer.close()
+
+
+__all__ = ['pipeline']
@@ -1,30 +1,643 @@
+import array
+import codecs
 import json
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import struct
 import subprocess
+import tempfile
+import threading
 from ._run import Error
-from ._utils import convert_kwargs_to_cmd_line_args
+from ._utils import (
+    basestring,
+    CacheInfo,
+    convert_kwargs_to_cmd_line_args,
+    import_numpy,
+    LruCache,
+)
+from collections import namedtuple
 
 
-def probe(filename, cmd='ffprobe', timeout=None, **kwargs):
-    """Run ffprobe on the specified file and return a JSON representation of the output.
+def _get_file_stamp(filename):
+    """Get ``(realpath, size, mtime_ns)`` of a local file, or None if ``filename``
+    isn't one (e.g. a URL).
+    """
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError, ValueError):
+        return None
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return os.path.realpath(filename), stat.st_size, mtime_ns
 
-    Raises:
-        :class:`ffmpeg.Error`: if ffprobe returns a non-zero exit code,
-            an :class:`Error` is returned with a generic error message.
-            The stderr output can be retrieved by accessing the
-            ``stderr`` property of the exception.
+
+class ProbeCache(object):
+    """Cache of :meth:`probe` (and :meth:`probe_index`) results for local files.
+
+    Results are keyed on the file's real path, size and modification time and the
+    ffprobe arguments, so a file that changes is probed again.  They are kept in
+    an in-memory LRU cache of ``maxsize`` entries and, if ``path`` is specified,
+    in an SQLite database at that path, which persists across processes.  Inputs
+    that aren't local files (e.g. URLs) are never cached.
+
+    Example:
+        ::
+
+            cache = ffmpeg.ProbeCache(path=os.path.expanduser('~/.cache/probe.db'))
+            info = ffmpeg.probe('in.mp4', cache=cache)
+            print(cache.info())
     """
-    args = [cmd, '-show_format', '-show_streams', '-of', 'json']
-    args += convert_kwargs_to_cmd_line_args(kwargs)
-    args += [filename]
 
+    def __init__(self, maxsize=1024, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.__memory = LruCache(maxsize)
+        self.__lock = threading.Lock()
+        self.__db = None
+
+    def __get_db(self):
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.path, check_same_thread=False)
+            self.__db.execute(
+                'CREATE TABLE IF NOT EXISTS probe_cache ('
+                'key TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, output TEXT)'
+            )
+        return self.__db
+
+    def __get_from_db(self, key, size, mtime_ns):
+        with self.__lock:
+            row = (
+                self.__get_db()
+                .execute(
+                    'SELECT output FROM probe_cache '
+                    'WHERE key = ? AND size = ? AND mtime_ns = ?',
+                    (key, size, mtime_ns),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+        output = row[0]
+        if isinstance(output, sqlite3.Binary):
+            output = output[:]  # python 2 returns blobs as buffers
+        return output
+
+    def __put_in_db(self, key, size, mtime_ns, output):
+        if isinstance(output, bytes):
+            output = sqlite3.Binary(output)
+        with self.__lock:
+            db = self.__get_db()
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO probe_cache VALUES (?, ?, ?, ?)',
+                    (key, size, mtime_ns, output),
+                )
+
+    def get_output(self, filename, args, run):
+        """Get the output of ffprobe ``args`` for ``filename``, calling ``run()``
+        to produce it on a miss.
+        """
+        stamp = _get_file_stamp(filename)
+        if stamp is None:
+            return run()
+        realpath, size, mtime_ns = stamp
+        key = (realpath, tuple(args), size, mtime_ns)
+        output = self.__memory.get(key)
+        if output is None and self.path is not None:
+            db_key = json.dumps([realpath] + list(args))
+            output = self.__get_from_db(db_key, size, mtime_ns)
+            if output is not None:
+                self.__memory.put(key, output)
+        with self.__lock:
+            if output is not None:
+                self.hits += 1
+                return output
+            self.misses += 1
+        output = run()
+        self.__memory.put(key, output)
+        if self.path is not None:
+            self.__put_in_db(db_key, size, mtime_ns, output)
+        return output
+
+    def clear(self):
+        """Remove all cached results, including those stored on disk."""
+        self.__memory.clear()
+        with self.__lock:
+            self.hits = 0
+            self.misses = 0
+            if self.path is not None:
+                db = self.__get_db()
+                with db:
+                    db.execute('DELETE FROM probe_cache')
+
+    def info(self):
+        """Get a ``CacheInfo`` tuple of hit/miss counters; ``currsize`` only counts
+        in-memory entries.
+        """
+        memory_info = self.__memory.info()
+        with self.__lock:
+            return CacheInfo(
+                self.hits, self.misses, memory_info.maxsize, memory_info.currsize
+            )
+
+
+def _run_ffprobe(args, timeout):
     p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     communicate_kwargs = {}
     if timeout is not None:
         communicate_kwargs['timeout'] = timeout
-    out, err = p.communicate(**communicate_kwargs)
+    try:
+        out, err = p.communicate(**communicate_kwargs)
+    except BaseException:
+        # E.g. the timeout expired: don't leave ffprobe running.
+        p.kill()
+        p.communicate()
+        raise
     if p.returncode != 0:
         raise Error('ffprobe', out, err)
-    return json.loads(out.decode('utf-8'))
+    return out.decode('utf-8')
+
+
+_INT_PATTERN = re.compile(r'-?\d+$')
+_FLOAT_PATTERN = re.compile(r'-?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+def _convert_values(item):
+    """Convert numeric strings in ffprobe output (e.g. ``duration``) to numbers,
+    leaving tags alone.
+    """
+    if isinstance(item, dict):
+        return {
+            key: value if key == 'tags' else _convert_values(value)
+            for key, value in item.items()
+        }
+    if isinstance(item, list):
+        return [_convert_values(value) for value in item]
+    if isinstance(item, basestring):
+        if _INT_PATTERN.match(item):
+            return int(item)
+        if _FLOAT_PATTERN.match(item):
+            return float(item)
+    return item
+
+
+def _get_probe_args(cmd, entries, kwargs):
+    if entries is not None:
+        if not isinstance(entries, basestring):
+            entries = ':'.join(entries)
+        args = [cmd, '-show_entries', entries, '-of', 'json']
+    else:
+        args = [cmd, '-show_format', '-show_streams', '-of', 'json']
+    return args + convert_kwargs_to_cmd_line_args(kwargs)
+
+
+def probe(filename, cmd='ffprobe', timeout=None, cache=None, entries=None, **kwargs):
+    """Run ffprobe on the specified file and return a JSON representation of the output.
+
+    Args:
+        cache: a :class:`ProbeCache` to look up (and store) the result in, if
+            ``filename`` is a local file.
+        entries: if specified, only fetch these entries, e.g. ``['stream=width,height',
+            'format=duration']``, instead of all format and stream information;
+            they are passed to ffprobe as ``-show_entries``, which is much cheaper
+            for files with lots of metadata or streams.  Numeric values are
+            converted to ``int`` or ``float`` in the result.  Combine with
+            ``select_streams`` (e.g. ``select_streams='v:0'``) to only fetch
+            some streams.
+
+    Raises:
+        :class:`ffmpeg.Error`: if ffprobe returns a non-zero exit code,
+            an :class:`Error` is returned with a generic error message.
+            The stderr output can be retrieved by accessing the
+            ``stderr`` property of the exception.
+    """
+    args = _get_probe_args(cmd, entries, kwargs)
+
+    def run():
+        return _run_ffprobe(args + [filename], timeout)
+
+    if cache is not None:
+        output = cache.get_output(filename, args, run)
+    else:
+        output = run()
+    if entries is not None:
+        return _convert_values(json.loads(output))
+    return json.loads(output)
+
+
+class ProbeResult(namedtuple('ProbeResult', ['filename', 'info', 'error'])):
+    """Result of probing one file with :meth:`probe_many`: ``info`` is what
+    :meth:`probe` returned, or None if it raised ``error``.
+    """
+
+    __slots__ = ()
+
+
+def _probe_files(jobs, results, probe_kwargs):
+    while True:
+        filename = jobs.get()
+        if filename is None:
+            break
+        try:
+            result = ProbeResult(filename, probe(filename, **probe_kwargs), None)
+        except Exception as e:
+            result = ProbeResult(filename, None, e)
+        results.put(result)
+
+
+def probe_many(
+    filenames, max_workers=None, timeout=None, cmd='ffprobe', cache=None, **kwargs
+):
+    """Probe many files concurrently, yielding a :class:`ProbeResult` for each file
+    as soon as it has been probed (so not necessarily in order).
+
+    At most ``max_workers`` ffprobe processes run at once (by default, the number
+    of CPUs), and ``filenames`` is consumed lazily, so it can be a generator over
+    a huge directory tree.  A file that can't be probed is reported with the
+    exception :meth:`probe` raised (e.g. :class:`ffmpeg.Error` or
+    ``subprocess.TimeoutExpired``) rather than stopping the batch.
+
+    Args:
+        timeout: timeout for each ffprobe process, in seconds.
+        cache: a :class:`ProbeCache`; see :meth:`probe`.
+        **kwargs: keyword-arguments passed to :meth:`probe`.
+
+    Example:
+        ::
+
+            for result in ffmpeg.probe_many(glob.iglob('videos/**/*.mp4')):
+                if result.error is not None:
+                    print(result.filename, result.error.stderr)
+                else:
+                    print(result.filename, result.info['format']['duration'])
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    probe_kwargs = dict(kwargs, timeout=timeout, cmd=cmd, cache=cache)
+    jobs = queue.Queue()
+    results = queue.Queue()
+    threads = [
+        threading.Thread(target=_probe_files, args=(jobs, results, probe_kwargs))
+        for _ in range(max_workers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    filenames = iter(filenames)
+    pending = 0
+    try:
+        # Only hand out as many files as there are workers, so that no more
+        # filenames are consumed than needed.
+        for filename in filenames:
+            jobs.put(filename)
+            pending += 1
+            if pending == max_workers:
+                break
+        while pending:
+            result = results.get()
+            pending -= 1
+            for filename in filenames:
+                jobs.put(filename)
+                pending += 1
+                break
+            yield result
+    finally:
+        for _ in threads:
+            jobs.put(None)
+
+
+def _iter_ffprobe_output(args, iter_stdout):
+    """Run ffprobe and yield pieces of its output (as split by
+    ``iter_stdout(stdout)``) as they are produced, rather than buffering all of it.
+    """
+    # stderr goes to a file rather than a pipe, so that ffprobe can't block on it
+    # while stdout is being read.
+    with tempfile.TemporaryFile() as err_file:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=err_file)
+        completed = False
+        try:
+            for item in iter_stdout(p.stdout):
+                yield item
+            completed = True
+        finally:
+            p.stdout.close()
+            if not completed and p.poll() is None:
+                p.kill()
+            p.wait()
+        if p.returncode != 0:
+            err_file.seek(0)
+            raise Error('ffprobe', None, err_file.read())
+
+
+def _iter_ffprobe_lines(args):
+    return _iter_ffprobe_output(args, iter)
+
+
+def _iter_ffprobe_chunks(args, chunk_size=64 * 1024):
+    return _iter_ffprobe_output(
+        args, lambda stdout: iter(lambda: stdout.read(chunk_size), b'')
+    )
+
+
+_WHITESPACE_PATTERN = re.compile(r'[\s,]*')
+
+
+def _iter_json_records(chunks):
+    """Incrementally parse ffprobe's JSON output, yielding a ``(section, record)``
+    tuple for each element of its top-level arrays (e.g. ``('packets', {...})``)
+    and each of its top-level objects (e.g. ``('format', {...})``) as soon as it
+    is complete, so that only one record is held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    # States: 'start' (before the top-level object), 'key' (before a section
+    # name), 'value' (before a section's value), 'array' (inside a section's
+    # array) and 'end'.
+    state = 'start'
+    section = None
+    chunks = iter(chunks)
+    eof = False
+    while state != 'end':
+        pos = _WHITESPACE_PATTERN.match(buffer, pos).end()
+        # Each step only updates `pos` and `state` once its token is complete.
+        try:
+            if pos == len(buffer):
+                raise ValueError('need more data')
+            char = buffer[pos]
+            record = None
+            if state == 'start':
+                if char != '{':
+                    raise ValueError('expected "{"')
+                next_pos, next_state = pos + 1, 'key'
+            elif state == 'key':
+                if char == '}':
+                    next_pos, next_state = pos + 1, 'end'
+                else:
+                    section, next_pos = decoder.raw_decode(buffer, pos)
+                    next_pos = _WHITESPACE_PATTERN.match(buffer, next_pos).end()
+                    if buffer[next_pos : next_pos + 1] != ':':
+                        raise ValueError('expected ":"')
+                    next_pos, next_state = next_pos + 1, 'value'
+            elif state == 'value':
+                if char == '[':
+                    next_pos, next_state = pos + 1, 'array'
+                else:
+                    record, next_pos = decoder.raw_decode(buffer, pos)
+                    next_state = 'key'
+            elif char == ']':
+                next_pos, next_state = pos + 1, 'key'
+            else:
+                record, next_pos = decoder.raw_decode(buffer, pos)
+                next_state = 'array'
+        except ValueError:
+            # The next token is incomplete (or invalid): read more data.
+            if eof:
+                raise ValueError(
+                    'failed to parse ffprobe output at {!r}'.format(buffer[pos:][:100])
+                )
+            # Read until the unparsed data has at least doubled, so that a record
+            # spanning many chunks is re-parsed a logarithmic number of times
+            # rather than once per chunk.
+            pieces = [buffer[pos:]]
+            size = len(pieces[0])
+            pos = 0
+            while True:
+                try:
+                    piece = utf8_decoder.decode(next(chunks))
+                except StopIteration:
+                    pieces.append(utf8_decoder.decode(b'', final=True))
+                    eof = True
+                    break
+                pieces.append(piece)
+                size += len(piece)
+                if size >= 2 * len(pieces[0]):
+                    break
+            buffer = ''.join(pieces)
+            continue
+        pos, state = next_pos, next_state
+        if record is not None:
+            yield section, record
+        # Drop parsed data, so the buffer only holds about one record.
+        if pos > 64 * 1024:
+            buffer = buffer[pos:]
+            pos = 0
+    # Consume the rest of the output, so that ffprobe's exit code is checked.
+    for _ in chunks:
+        pass
+
+
+def probe_iter(filename, cmd='ffprobe', entries=None, chunk_size=64 * 1024, **kwargs):
+    """Run ffprobe on the specified file and iterate over the records of its output
+    as they are parsed.
+
+    Unlike :meth:`probe`, ffprobe's output is read and parsed incrementally in
+    chunks of ``chunk_size`` bytes, so memory use stays flat even for output with
+    millions of packets, frames or chapters (e.g. with ``show_frames=None``).  The
+    arguments are the same as for :meth:`probe`.
+
+    Yields:
+        ``(section, record)`` tuples in output order, one for each element of the
+        array sections (e.g. ``('streams', {...})``, ``('packets', {...})``, or
+        ``('packets_and_frames', {...})`` if both packets and frames are shown,
+        with a ``type`` field) and one for each object section (e.g.
+        ``('format', {...})``).
+
+    Raises:
+        :class:`ffmpeg.Error`: if ffprobe returns a non-zero exit code, once all
+            of its output has been read.
+
+    Example:
+        ::
+
+            for section, record in ffmpeg.probe_iter('in.mp4', show_frames=None):
+                if section == 'frames':
+                    print(record['pts_time'])
+    """
+    args = _get_probe_args(cmd, entries, kwargs) + [filename]
+    records = _iter_json_records(_iter_ffprobe_chunks(args, chunk_size))
+    for section, record in records:
+        if entries is not None:
+            record = _convert_values(record)
+        yield section, record
+
+
+def _parse_compact_line(line):
+    """Parse a line of ffprobe ``compact`` output (``key=value|key=value...``)."""
+    fields = {}
+    for item in line.rstrip(b'\r\n').split(b'|'):
+        key, sep, value = item.partition(b'=')
+        if sep:
+            fields[key] = value
+    return fields
+
+
+def _parse_time(value):
+    return float('nan') if value in (None, b'N/A') else float(value)
+
+
+def _parse_int(value):
+    return -1 if value in (None, b'N/A') else int(value)
+
+
+class PacketIndex(namedtuple('PacketIndex', ['pts', 'dts', 'pos', 'size', 'key'])):
+    """Per-packet (or per-frame) index of a stream, as returned by
+    :meth:`probe_index`.
+
+    Each attribute is an ``array.array`` (or numpy array) column with one entry
+    per packet, in file order:
+
+    Attributes:
+        pts: presentation timestamps in seconds (``float``; NaN if unknown).
+        dts: decoding timestamps in seconds (``float``; NaN if unknown).
+        pos: byte offsets in the file (-1 if unknown).
+        size: sizes in bytes (-1 if unknown).
+        key: 1 for keyframes, 0 otherwise.
+    """
+
+    __slots__ = ()
+
+    @property
+    def keyframe_times(self):
+        """Presentation timestamps of the keyframes, in seconds."""
+        return [pts for pts, key in zip(self.pts, self.key) if key]
+
+
+# Byte offsets and sizes are stored as doubles (exact up to 2**53) rather than as
+# 64-bit integers, since python 2's ``array`` has no 64-bit integer typecode.
+_INDEX_TYPECODES = PacketIndex('d', 'd', 'd', 'd', 'B')
+
+
+def _array_to_bytes(column):
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()  # python 2
+
+
+def _array_from_bytes(column, data):
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)  # python 2
+
+
+def _pack_index(index):
+    """Serialize a :class:`PacketIndex` of arrays, e.g. for :class:`ProbeCache`."""
+    return struct.pack('<Q', len(index.pts)) + b''.join(
+        _array_to_bytes(column) for column in index
+    )
+
+
+def _unpack_index(data):
+    (count,) = struct.unpack_from('<Q', data)
+    columns = []
+    offset = 8
+    for typecode in _INDEX_TYPECODES:
+        column = array.array(typecode)
+        size = count * column.itemsize
+        _array_from_bytes(column, data[offset : offset + size])
+        offset += size
+        columns.append(column)
+    return PacketIndex(*columns)
+
+
+def _read_index(args, frames):
+    columns = PacketIndex(*[array.array(typecode) for typecode in _INDEX_TYPECODES])
+    if frames:
+        keys = (b'pts_time', b'pkt_dts_time', b'pkt_pos', b'pkt_size')
+    else:
+        keys = (b'pts_time', b'dts_time', b'pos', b'size')
+    pts_key, dts_key, pos_key, size_key = keys
+    for line in _iter_ffprobe_lines(args):
+        fields = _parse_compact_line(line)
+        if not fields:
+            continue
+        columns.pts.append(_parse_time(fields.get(pts_key)))
+        columns.dts.append(_parse_time(fields.get(dts_key)))
+        columns.pos.append(_parse_int(fields.get(pos_key)))
+        columns.size.append(_parse_int(fields.get(size_key)))
+        if frames:
+            columns.key.append(fields.get(b'key_frame') == b'1')
+        else:
+            columns.key.append(b'K' in fields.get(b'flags', b''))
+    return columns
+
+
+def probe_index(
+    filename, stream='v:0', frames=False, as_numpy=False, cmd='ffprobe', cache=None
+):
+    """Get the timestamps, byte offsets, sizes and keyframe flags of every packet
+    of a stream, e.g. for seeking, segmenting or thumbnailing.
+
+    ffprobe's output is requested in the compact text format with only the needed
+    fields, and parsed line by line as it is produced into ``array.array``
+    columns, so memory use stays around 33 bytes per packet regardless of the
+    size of the file.
+
+    Args:
+        stream: stream specifier of the stream to index (``-select_streams``).
+        frames: if True, index decoded frames (``-show_frames``) rather than
+            packets (``-show_packets``); this is much slower, since every frame
+            is decoded, but gives presentation order.
+        as_numpy: if True, return numpy arrays (sharing memory with the arrays)
+            instead of ``array.array`` columns.
+        cmd: ffprobe command.
+        cache: a :class:`ProbeCache` to look up (and store) the index in; indexes
+            are stored in a compact binary form.
+
+    Returns:
+        A :class:`PacketIndex`.
+
+    Example:
+        ::
+
+            index = ffmpeg.probe_index('in.mp4')
+            print(index.keyframe_times)
+    """
+    if frames:
+        entries = 'frame=pts_time,pkt_dts_time,pkt_pos,pkt_size,key_frame'
+    else:
+        entries = 'packet=pts_time,dts_time,pos,size,flags'
+    args = [
+        cmd,
+        '-v',
+        'error',
+        '-select_streams',
+        stream,
+        '-show_entries',
+        entries,
+        '-of',
+        'compact=print_section=0',
+        filename,
+    ]
+    if cache is not None:
+        index = _unpack_index(
+            cache.get_output(
+                filename, args, lambda: _pack_index(_read_index(args, frames))
+            )
+        )
+    else:
+        index = _read_index(args, frames)
+    if as_numpy:
+        numpy = import_numpy()
+        index = PacketIndex(
+            *[numpy.frombuffer(column, column.typecode) for column in index]
+        )
+    return index
 
 
-__all__ = ['probe']
+__all__ = [
+    'probe',
+    'probe_index',
+    'probe_iter',
+    'probe_many',
+    'PacketIndex',
+    'ProbeCache',
+    'ProbeResult',
+]
@@ -1,15 +1,20 @@
 from __future__ import unicode_literals
 from .dag import get_outgoing_edges, topo_sort
-from ._utils import basestring, convert_kwargs_to_cmd_line_args
-from builtins import str
-from functools import reduce
+from ._transform import insert_splits
+from ._utils import basestring, convert_kwargs_to_cmd_line_args, LruCache
+from builtins import object, str
+import collections
 import copy
-import operator
+import multiprocessing
+import os
 import subprocess
+import tempfile
+import threading
 
 from ._ffmpeg import input, output
 from .nodes import (
-    get_stream_spec_nodes,
+    get_stream_map,
+    get_stream_map_nodes,
     FilterNode,
     GlobalNode,
     InputNode,
@@ -32,10 +37,12 @@ class Error(Exception):
         self.stderr = stderr
 
 
-def _get_input_args(input_node):
+def _get_input_args(input_node, threads=None):
     if input_node.name == input.__name__:
         kwargs = copy.copy(input_node.kwargs)
         filename = kwargs.pop('filename')
+        if threads is not None:
+            kwargs.setdefault('threads', threads)
         fmt = kwargs.pop('format', None)
         video_size = kwargs.pop('video_size', None)
         args = []
@@ -69,28 +76,64 @@ def _format_output_stream_name(stream_name_map, edge):
     return '[{}]'.format(stream_name_map[edge.upstream_node, edge.upstream_label])
 
 
-def _get_filter_spec(node, outgoing_edge_map, stream_name_map):
-    incoming_edges = node.incoming_edges
-    outgoing_edges = get_outgoing_edges(node, outgoing_edge_map)
+def _get_filter_spec(nodes, outgoing_edge_maps, stream_name_map):
+    """Build the filter spec for a chain of one or more filter nodes, each of which
+    feeds only into the next.
+    """
     inputs = [
-        _format_input_stream_name(stream_name_map, edge) for edge in incoming_edges
+        _format_input_stream_name(stream_name_map, edge)
+        for edge in nodes[0].incoming_edges
+    ]
+    filters = [
+        node._get_filter(get_outgoing_edges(node, outgoing_edge_maps[node]))
+        for node in nodes
     ]
     outputs = [
-        _format_output_stream_name(stream_name_map, edge) for edge in outgoing_edges
+        _format_output_stream_name(stream_name_map, edge)
+        for edge in get_outgoing_edges(nodes[-1], outgoing_edge_maps[nodes[-1]])
     ]
-    filter_spec = '{}{}{}'.format(
-        ''.join(inputs), node._get_filter(outgoing_edges), ''.join(outputs)
-    )
+    filter_spec = '{}{}{}'.format(''.join(inputs), ','.join(filters), ''.join(outputs))
     return filter_spec
 
 
-def _allocate_filter_stream_names(filter_nodes, outgoing_edge_maps, stream_name_map):
+def _get_fused_nodes(filter_nodes, outgoing_edge_maps):
+    """Find filter nodes that can be emitted as part of a linear filter chain
+    (e.g. ``[0]hflip,crop=...,hue=...[s0]``) rather than as separate segments
+    connected by named pads.
+
+    Returns:
+        A dictionary mapping each node whose only outgoing edge goes to a filter
+        node with a single input onto that downstream node.
+    """
+    next_nodes = {}
+    for upstream_node in filter_nodes:
+        outgoing_edges = get_outgoing_edges(
+            upstream_node, outgoing_edge_maps[upstream_node]
+        )
+        if len(outgoing_edges) != 1:
+            continue
+        edge = outgoing_edges[0]
+        downstream_node = edge.downstream_node
+        if (
+            isinstance(downstream_node, FilterNode)
+            and len(downstream_node.incoming_edges) == 1
+            and not edge.upstream_selector
+        ):
+            next_nodes[upstream_node] = downstream_node
+    return next_nodes
+
+
+def _allocate_filter_stream_names(
+    filter_nodes, outgoing_edge_maps, stream_name_map, next_nodes
+):
     stream_count = 0
     for upstream_node in filter_nodes:
+        if upstream_node in next_nodes:
+            continue
         outgoing_edge_map = outgoing_edge_maps[upstream_node]
         for upstream_label, downstreams in sorted(outgoing_edge_map.items()):
             if len(downstreams) > 1:
-                # TODO: automatically insert `splits` ahead of time via graph transformation.
+                # Shouldn't happen, since `insert_splits` takes care of fan-outs.
                 raise ValueError(
                     'Encountered {} with multiple outgoing edges with same upstream '
                     'label {!r}; a `split` filter is probably required'.format(
@@ -102,11 +145,21 @@ def _allocate_filter_stream_names(filter_nodes, outgoing_edge_maps, stream_name_
 
 
 def _get_filter_arg(filter_nodes, outgoing_edge_maps, stream_name_map):
-    _allocate_filter_stream_names(filter_nodes, outgoing_edge_maps, stream_name_map)
-    filter_specs = [
-        _get_filter_spec(node, outgoing_edge_maps[node], stream_name_map)
-        for node in filter_nodes
-    ]
+    next_nodes = _get_fused_nodes(filter_nodes, outgoing_edge_maps)
+    fused_nodes = set(next_nodes.values())
+    _allocate_filter_stream_names(
+        filter_nodes, outgoing_edge_maps, stream_name_map, next_nodes
+    )
+    filter_specs = []
+    for node in filter_nodes:
+        if node in fused_nodes:
+            continue
+        chain = [node]
+        while chain[-1] in next_nodes:
+            chain.append(next_nodes[chain[-1]])
+        filter_specs.append(
+            _get_filter_spec(chain, outgoing_edge_maps, stream_name_map)
+        )
     return ';'.join(filter_specs)
 
 
@@ -114,7 +167,7 @@ def _get_global_args(node):
     return list(node.args)
 
 
-def _get_output_args(node, stream_name_map):
+def _get_output_args(node, stream_name_map, threads=None):
     if node.name != output.__name__:
         raise ValueError('Unsupported output node: {}'.format(node))
     args = []
@@ -132,6 +185,8 @@ def _get_output_args(node, stream_name_map):
 
     kwargs = copy.copy(node.kwargs)
     filename = kwargs.pop('filename')
+    if threads is not None:
+        kwargs.setdefault('threads', threads)
     if 'format' in kwargs:
         args += ['-f', kwargs.pop('format')]
     if 'video_bitrate' in kwargs:
@@ -148,33 +203,170 @@ def _get_output_args(node, stream_name_map):
     return args
 
 
-@output_operator()
-def get_args(stream_spec, overwrite_output=False):
-    """Build command-line arguments to be passed to ffmpeg."""
-    nodes = get_stream_spec_nodes(stream_spec)
+_args_cache = LruCache(maxsize=128)
+
+
+def _get_args(nodes, overwrite_output, threads=None):
     args = []
     # TODO: group nodes together, e.g. `-i somefile -r somerate`.
     sorted_nodes, outgoing_edge_maps = topo_sort(nodes)
+    split_nodes = insert_splits(nodes, sorted_nodes, outgoing_edge_maps, [])
+    if split_nodes is not nodes:
+        sorted_nodes, outgoing_edge_maps = topo_sort(split_nodes)
     input_nodes = [node for node in sorted_nodes if isinstance(node, InputNode)]
     output_nodes = [node for node in sorted_nodes if isinstance(node, OutputNode)]
     global_nodes = [node for node in sorted_nodes if isinstance(node, GlobalNode)]
     filter_nodes = [node for node in sorted_nodes if isinstance(node, FilterNode)]
     stream_name_map = {(node, None): str(i) for i, node in enumerate(input_nodes)}
     filter_arg = _get_filter_arg(filter_nodes, outgoing_edge_maps, stream_name_map)
-    args += reduce(operator.add, [_get_input_args(node) for node in input_nodes])
+    for node in input_nodes:
+        args.extend(_get_input_args(node, threads))
     if filter_arg:
         args += ['-filter_complex', filter_arg]
-    args += reduce(
-        operator.add, [_get_output_args(node, stream_name_map) for node in output_nodes]
-    )
-    args += reduce(operator.add, [_get_global_args(node) for node in global_nodes], [])
+    for node in output_nodes:
+        args.extend(_get_output_args(node, stream_name_map, threads))
+    if threads is not None:
+        # Before any global args, so that those take precedence.
+        args += ['-filter_threads', str(threads)]
+        if filter_arg:
+            args += ['-filter_complex_threads', str(threads)]
+    for node in global_nodes:
+        args.extend(_get_global_args(node))
     if overwrite_output:
         args += ['-y']
     return args
 
 
 @output_operator()
-def compile(stream_spec, cmd='ffmpeg', overwrite_output=False):
+def get_args(stream_spec, overwrite_output=False, threads=None):
+    """Build command-line arguments to be passed to ffmpeg.
+
+    If ``threads`` is specified, it is used as the ``-threads`` option of every
+    input and output that doesn't set its own, and as the ``-filter_threads`` and
+    ``-filter_complex_threads`` global options, which caps the number of threads
+    ffmpeg uses for decoding, filtering and encoding.
+
+    Structurally identical nodes (the same filters, with arguments of the same
+    values and types, fed by the same inputs) compare equal, and nodes that merely
+    hash the same don't.  So if the same chain of filters is built more than once
+    (e.g. by reusable builder functions), it only appears once on the command line,
+    and a ``split``/``asplit`` filter is inserted to feed all of its consumers;
+    ffmpeg then decodes and filters each unique chain once.
+
+    Since nodes are immutable, the arguments built for a given stream spec are
+    memoized in a bounded LRU cache, so repeatedly compiling the same graph (e.g.
+    for logging, dry runs and then :meth:`run`) only builds the arguments once.  Use
+    ``get_args.cache_info()`` to inspect the cache hit/miss counters and
+    ``get_args.cache_clear()`` to empty it.
+    """
+    stream_map = get_stream_map(stream_spec)
+    nodes = get_stream_map_nodes(stream_map)
+    # Streams in the key compare structurally (not just by hash), so graphs whose
+    # hashes collide never share an entry.
+    key = (tuple(stream_map.items()), overwrite_output, threads)
+    args = _args_cache.get(key)
+    if args is None:
+        args = tuple(_get_args(nodes, overwrite_output, threads))
+        _args_cache.put(key, args)
+    return list(args)
+
+
+get_args.cache_info = _args_cache.info
+get_args.cache_clear = _args_cache.clear
+
+
+# Filter graphs longer than this (in bytes) are written to a file and passed with
+# ``-filter_complex_script`` when ``filter_complex_script=None``.  Linux refuses any
+# single argument longer than 128 KiB, and huge argv strings also slow down spawning.
+FILTER_COMPLEX_SCRIPT_THRESHOLD = 32 * 1024
+
+
+def _spill_filter_complex(args, filter_complex_script):
+    """Move the ``-filter_complex`` argument into a temporary script file if needed.
+
+    Returns:
+        An ``(args, script_filename)`` tuple, where ``script_filename`` is None if
+        the filter graph was left on the command line.
+    """
+    if '-filter_complex' not in args:
+        return args, None
+    index = args.index('-filter_complex')
+    filter_arg = args[index + 1].encode('utf-8')
+    if filter_complex_script is None:
+        filter_complex_script = len(filter_arg) > FILTER_COMPLEX_SCRIPT_THRESHOLD
+    if not filter_complex_script:
+        return args, None
+    with tempfile.NamedTemporaryFile(
+        prefix='ffmpeg-filter-', suffix='.txt', delete=False
+    ) as f:
+        f.write(filter_arg)
+    args = args[:index] + ['-filter_complex_script', f.name] + args[index + 2 :]
+    return args, f.name
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+class _FilterComplexScriptPopen(subprocess.Popen):
+    """A ``Popen`` that removes its filter script file once the process exits."""
+
+    def __init__(self, script_filename, *args, **kwargs):
+        self.script_filename = script_filename
+        try:
+            super(_FilterComplexScriptPopen, self).__init__(*args, **kwargs)
+        except Exception:
+            _remove_file(script_filename)
+            raise
+
+    def poll(self):
+        retcode = super(_FilterComplexScriptPopen, self).poll()
+        if retcode is not None:
+            _remove_file(self.script_filename)
+        return retcode
+
+    def wait(self, *args, **kwargs):
+        retcode = super(_FilterComplexScriptPopen, self).wait(*args, **kwargs)
+        _remove_file(self.script_filename)
+        return retcode
+
+
+def _get_std_streams(pipe_stdin, pipe_stdout, pipe_stderr, quiet):
+    """Get the ``stdin``, ``stdout`` and ``stderr`` keyword-arguments for starting
+    ffmpeg with ``subprocess`` or ``asyncio``; see :meth:`run_async`.
+    """
+    stdin_stream = subprocess.PIPE if pipe_stdin else None
+    stdout_stream = subprocess.PIPE if pipe_stdout else None
+    stderr_stream = subprocess.PIPE if pipe_stderr else None
+    if quiet:
+        stderr_stream = subprocess.STDOUT
+        stdout_stream = subprocess.DEVNULL
+    return dict(stdin=stdin_stream, stdout=stdout_stream, stderr=stderr_stream)
+
+
+def _popen(
+    args, pipe_stdin, pipe_stdout, pipe_stderr, quiet, cwd, filter_complex_script
+):
+    """Start ffmpeg with already-compiled ``args``; see :meth:`run_async`."""
+    args, script_filename = _spill_filter_complex(args, filter_complex_script)
+    popen_kwargs = _get_std_streams(pipe_stdin, pipe_stdout, pipe_stderr, quiet)
+    popen_kwargs['cwd'] = cwd
+    if script_filename is not None:
+        return _FilterComplexScriptPopen(script_filename, args, **popen_kwargs)
+    return subprocess.Popen(args, **popen_kwargs)
+
+
+@output_operator()
+def compile(
+    stream_spec,
+    cmd='ffmpeg',
+    overwrite_output=False,
+    filter_complex_script=False,
+    threads=None,
+):
     """Build command-line for invoking ffmpeg.
 
     The :meth:`run` function uses this to build the command line
@@ -184,12 +376,112 @@ def compile(stream_spec, cmd='ffmpeg', overwrite_output=False):
 
     This is the same as calling :meth:`get_args` except that it also
     includes the ``ffmpeg`` command as the first argument.
+
+    Args:
+        filter_complex_script: if True, write the filter graph to a temporary
+            file and pass it with ``-filter_complex_script`` instead of
+            ``-filter_complex``; if None, only do so when the filter graph is
+            longer than ``FILTER_COMPLEX_SCRIPT_THRESHOLD`` bytes.  The caller is
+            responsible for removing the file.
+        threads: number of threads for ffmpeg to use; see :meth:`get_args`.
     """
     if isinstance(cmd, basestring):
         cmd = [cmd]
     elif type(cmd) != list:
         cmd = list(cmd)
-    return cmd + get_args(stream_spec, overwrite_output=overwrite_output)
+    args = cmd + get_args(
+        stream_spec, overwrite_output=overwrite_output, threads=threads
+    )
+    return _spill_filter_complex(args, filter_complex_script)[0]
+
+
+class CpuBudget(object):
+    """A pool of CPUs shared by concurrently running ffmpeg processes.
+
+    Each process takes a number of CPUs from the budget before it starts, and is
+    limited to that many threads (see the ``threads`` argument of
+    :meth:`get_args`); processes wait while the budget is used up, so running many
+    at once doesn't oversubscribe the machine.  The free CPUs are split evenly
+    between the processes waiting for them.  Waiting processes are served in
+    first-come, first-served order, so a process waiting for many CPUs isn't
+    starved by ones that take any free CPU.
+
+    Args:
+        cpus: number of CPUs in the budget; defaults to the number of CPUs.
+        max_threads: most CPUs a single process takes when it doesn't say how
+            many jobs the CPUs are shared with (as :meth:`run` doesn't); defaults
+            to half the budget, so that a lone process can't keep concurrent
+            :meth:`run` calls from starting, e.g. while it can't use all of its
+            threads.  Set it to ``cpus`` to let a lone process take every CPU.
+    """
+
+    def __init__(self, cpus=None, max_threads=None):
+        self.cpus = cpus or multiprocessing.cpu_count()
+        self.max_threads = max_threads or max(1, self.cpus // 2)
+        self.__free = self.cpus
+        self.__waiters = collections.deque()
+        self.__condition = threading.Condition()
+
+    @property
+    def free(self):
+        """Number of CPUs not currently taken."""
+        return self.__free
+
+    def acquire(self, max_threads=None, share=None, exact=False):
+        """Wait for free CPUs and take some, returning how many were taken.
+
+        Args:
+            max_threads: maximum number of CPUs to take; defaults to the budget's
+                ``max_threads`` if ``share`` isn't specified.
+            share: number of jobs to split the free CPUs between; defaults to the
+                number of callers currently waiting in :meth:`acquire`.
+            exact: if True, wait until ``max_threads`` CPUs (or the whole budget,
+                if smaller or ``max_threads`` is None) are free and take exactly
+                that many.
+        """
+        if not exact and max_threads is None and share is None:
+            max_threads = self.max_threads
+        waiter = object()
+        with self.__condition:
+            self.__waiters.append(waiter)
+            try:
+                if exact:
+                    threads = min(max_threads or self.cpus, self.cpus)
+                else:
+                    threads = 1
+                while self.__waiters[0] is not waiter or self.__free < threads:
+                    self.__condition.wait()
+                if not exact:
+                    threads = max(1, self.__free // (share or len(self.__waiters)))
+                    if max_threads is not None:
+                        threads = min(threads, max_threads)
+                self.__free -= threads
+                return threads
+            finally:
+                self.__waiters.remove(waiter)
+                self.__condition.notify_all()
+
+    def release(self, threads):
+        """Return CPUs taken with :meth:`acquire`."""
+        with self.__condition:
+            self.__free += threads
+            self.__condition.notify_all()
+
+
+_cpu_budgets = {}
+_cpu_budgets_lock = threading.Lock()
+
+
+def _get_cpu_budget(cpu_budget):
+    """Get ``cpu_budget`` if it's a :class:`CpuBudget`, otherwise the process-wide
+    :class:`CpuBudget` with ``cpu_budget`` CPUs.
+    """
+    if isinstance(cpu_budget, CpuBudget):
+        return cpu_budget
+    with _cpu_budgets_lock:
+        if cpu_budget not in _cpu_budgets:
+            _cpu_budgets[cpu_budget] = CpuBudget(cpu_budget)
+        return _cpu_budgets[cpu_budget]
 
 
 @output_operator()
@@ -202,6 +494,8 @@ def run_async(
     quiet=False,
     overwrite_output=False,
     cwd=None,
+    filter_complex_script=None,
+    threads=None,
 ):
     """Asynchronously invoke ffmpeg for the supplied node graph.
 
@@ -213,6 +507,12 @@ def run_async(
         pipe_stderr: if True, connect pipe to subprocess stderr.
         quiet: shorthand for setting ``capture_stdout`` and
             ``capture_stderr``.
+        filter_complex_script: whether to pass the filter graph to ffmpeg
+            in a temporary file with ``-filter_complex_script``; see
+            :meth:`compile`.  Defaults to doing so only for very large filter
+            graphs.  The file is removed once the process has been waited
+            for (e.g. with ``wait()``, ``poll()`` or ``communicate()``).
+        threads: number of threads for ffmpeg to use; see :meth:`get_args`.
         **kwargs: keyword-arguments passed to ``get_args()`` (e.g.
             ``overwrite_output=True``).
 
@@ -280,19 +580,15 @@ def run_async(
 
     .. _subprocess Popen: https://docs.python.org/3/library/subprocess.html#popen-objects
     """
-    args = compile(stream_spec, cmd, overwrite_output=overwrite_output)
-    stdin_stream = subprocess.PIPE if pipe_stdin else None
-    stdout_stream = subprocess.PIPE if pipe_stdout else None
-    stderr_stream = subprocess.PIPE if pipe_stderr else None
-    if quiet:
-        stderr_stream = subprocess.STDOUT
-        stdout_stream = subprocess.DEVNULL
-    return subprocess.Popen(
+    args = compile(stream_spec, cmd, overwrite_output=overwrite_output, threads=threads)
+    return _popen(
         args,
-        stdin=stdin_stream,
-        stdout=stdout_stream,
-        stderr=stderr_stream,
-        cwd=cwd,
+        pipe_stdin,
+        pipe_stdout,
+        pipe_stderr,
+        quiet,
+        cwd,
+        filter_complex_script,
     )
 
 
@@ -306,6 +602,9 @@ def run(
     quiet=False,
     overwrite_output=False,
     cwd=None,
+    filter_complex_script=None,
+    threads=None,
+    cpu_budget=None,
 ):
     """Invoke ffmpeg for the supplied node graph.
 
@@ -316,11 +615,38 @@ def run(
         quiet: shorthand for setting ``capture_stdout`` and ``capture_stderr``.
         input: text to be sent to stdin (to be used with ``pipe:``
             ffmpeg inputs)
+        filter_complex_script: whether to pass the filter graph to ffmpeg
+            in a temporary file; see :meth:`run_async`.
+        threads: number of threads for ffmpeg to use; see :meth:`get_args`.
+        cpu_budget: a :class:`CpuBudget` shared with other concurrent runs, or
+            a number of CPUs to use the process-wide budget of that size.  ffmpeg
+            is started once CPUs are free in the budget, with ``threads`` set to
+            the number of CPUs it was granted (at most the budget's
+            ``max_threads``), unless ``threads`` is specified, in which case
+            that many are reserved.
         **kwargs: keyword-arguments passed to ``get_args()`` (e.g.
             ``overwrite_output=True``).
 
     Returns: (out, err) tuple containing captured stdout and stderr data.
     """
+    if cpu_budget is not None:
+        cpu_budget = _get_cpu_budget(cpu_budget)
+        threads = cpu_budget.acquire(threads, exact=threads is not None)
+        try:
+            return run(
+                stream_spec,
+                cmd,
+                capture_stdout=capture_stdout,
+                capture_stderr=capture_stderr,
+                input=input,
+                quiet=quiet,
+                overwrite_output=overwrite_output,
+                cwd=cwd,
+                filter_complex_script=filter_complex_script,
+                threads=threads,
+            )
+        finally:
+            cpu_budget.release(threads)
     process = run_async(
         stream_spec,
         cmd,
@@ -330,6 +656,8 @@ def run(
         quiet=quiet,
         overwrite_output=overwrite_output,
         cwd=cwd,
+        filter_complex_script=filter_complex_script,
+        threads=threads,
     )
     out, err = process.communicate(input)
     retcode = process.poll()
@@ -340,6 +668,7 @@ def run(
 
 __all__ = [
     'compile',
+    'CpuBudget',
     'Error',
     'get_args',
     'run',
@@ -0,0 +1,138 @@
+"""asyncio counterparts of :meth:`run_async` and :meth:`run` (Python 3 only)."""
+from __future__ import unicode_literals
+
+from ._run import _get_std_streams, _remove_file, _spill_filter_complex, compile, Error
+from .nodes import output_operator
+import asyncio
+
+
+# Keeps filter script clean-up tasks alive until they are done.
+_cleanup_tasks = set()
+
+
+async def _remove_file_after_exit(process, filename):
+    try:
+        await process.wait()
+    finally:
+        _remove_file(filename)
+
+
+@output_operator()
+async def run_asyncio(
+    stream_spec,
+    cmd='ffmpeg',
+    pipe_stdin=False,
+    pipe_stdout=False,
+    pipe_stderr=False,
+    quiet=False,
+    overwrite_output=False,
+    cwd=None,
+    filter_complex_script=None,
+    threads=None,
+):
+    """Start ffmpeg for the supplied node graph as an asyncio subprocess.
+
+    This is the asyncio counterpart of :meth:`run_async`, and takes the same
+    arguments.
+
+    Returns:
+        An `asyncio Process`_ object, whose ``stdin``, ``stdout`` and ``stderr``
+        are ``StreamWriter``/``StreamReader`` objects if piped.
+
+    Example:
+        ::
+
+            process = await (
+                ffmpeg
+                .input(in_filename)
+                .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+                .run_asyncio(pipe_stdout=True)
+            )
+            while True:
+                in_bytes = await process.stdout.read(65536)
+                if not in_bytes:
+                    break
+                ...
+            await process.wait()
+
+    .. _asyncio Process: https://docs.python.org/3/library/asyncio-subprocess.html#asyncio.subprocess.Process
+    """
+    args = compile(stream_spec, cmd, overwrite_output=overwrite_output, threads=threads)
+    args, script_filename = _spill_filter_complex(args, filter_complex_script)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            cwd=cwd,
+            **_get_std_streams(pipe_stdin, pipe_stdout, pipe_stderr, quiet)
+        )
+    except BaseException:
+        if script_filename is not None:
+            _remove_file(script_filename)
+        raise
+    if script_filename is not None:
+        task = asyncio.ensure_future(_remove_file_after_exit(process, script_filename))
+        _cleanup_tasks.add(task)
+        task.add_done_callback(_cleanup_tasks.discard)
+    return process
+
+
+@output_operator()
+async def run_aio(
+    stream_spec,
+    cmd='ffmpeg',
+    capture_stdout=False,
+    capture_stderr=False,
+    input=None,
+    quiet=False,
+    overwrite_output=False,
+    cwd=None,
+    filter_complex_script=None,
+    threads=None,
+):
+    """Invoke ffmpeg for the supplied node graph without blocking the event loop.
+
+    This is the asyncio counterpart of :meth:`run`, and takes the same arguments
+    except ``cpu_budget``, since waiting for CPUs would block the event loop.
+    If the calling task is cancelled, ffmpeg is terminated (and waited for) before
+    the cancellation propagates.
+
+    Returns: (out, err) tuple containing captured stdout and stderr data.
+
+    Example:
+        ::
+
+            out, _ = await (
+                ffmpeg
+                .input(in_filename)
+                .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+                .run_aio(capture_stdout=True)
+            )
+    """
+    process = await run_asyncio(
+        stream_spec,
+        cmd,
+        pipe_stdin=input is not None,
+        pipe_stdout=capture_stdout,
+        pipe_stderr=capture_stderr,
+        quiet=quiet,
+        overwrite_output=overwrite_output,
+        cwd=cwd,
+        filter_complex_script=filter_complex_script,
+        threads=threads,
+    )
+    try:
+        out, err = await process.communicate(input)
+    except BaseException:
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+            await asyncio.shield(process.wait())
+        raise
+    if process.returncode:
+        raise Error('ffmpeg', out, err)
+    return out, err
+
+
+__all__ = ['run_aio', 'run_asyncio']
@@ -0,0 +1,316 @@
+"""Graph transformations applied before building the command line.
+
+Each transformation is called as ``transform(downstream_nodes, sorted_nodes,
+outgoing_edge_maps, rewrites)``, where ``sorted_nodes`` and ``outgoing_edge_maps``
+come from :func:`topo_sort`, and returns the new downstream nodes (or
+``downstream_nodes`` itself if nothing changed).  A description of each rewrite is
+appended to the ``rewrites`` list.
+
+Nodes are immutable, so any node downstream of a change is rebuilt with
+:meth:`Node._replace_incoming_edge_map`.
+"""
+from __future__ import unicode_literals
+
+from .dag import topo_sort
+from .nodes import (
+    FilterNode,
+    get_stream_map,
+    get_stream_map_nodes,
+    InputNode,
+    output_operator,
+    Stream,
+)
+
+
+# Filters that produce audio.  Used to pick ``asplit`` over ``split`` when a filter
+# output needs to be fanned out; anything unknown is assumed to be video.
+_AUDIO_FILTER_NAMES = {
+    'acompressor',
+    'acrossfade',
+    'adelay',
+    'aecho',
+    'afade',
+    'aformat',
+    'aloop',
+    'amerge',
+    'amix',
+    'anull',
+    'apad',
+    'aresample',
+    'areverse',
+    'asetpts',
+    'asetrate',
+    'asplit',
+    'atempo',
+    'atrim',
+    'bass',
+    'channelmap',
+    'channelsplit',
+    'dynaudnorm',
+    'equalizer',
+    'highpass',
+    'join',
+    'loudnorm',
+    'lowpass',
+    'pan',
+    'silencedetect',
+    'silenceremove',
+    'treble',
+    'volume',
+}
+
+
+# Filters that turn audio into video (visualizations), so their output is video even
+# though their input is audio.
+_AUDIO_TO_VIDEO_FILTER_NAMES = {
+    'abitscope',
+    'ahistogram',
+    'avectorscope',
+    'showcqt',
+    'showfreqs',
+    'showspatial',
+    'showspectrum',
+    'showspectrumpic',
+    'showvolume',
+    'showwaves',
+    'showwavespic',
+}
+
+
+def _is_audio_stream(node, label, selector):
+    """Guess whether output ``label`` of ``node`` (with ``selector``) is an audio
+    stream.
+    """
+    while selector is None:
+        if not isinstance(node, FilterNode):
+            return False
+        elif node.name in _AUDIO_TO_VIDEO_FILTER_NAMES:
+            return False
+        elif node.name in _AUDIO_FILTER_NAMES:
+            return True
+        elif node.name == 'concat':
+            # concat has ``v`` video outputs followed by ``a`` audio outputs.
+            return (label or 0) >= node.kwargs.get('v', 1)
+        elif not node.incoming_edges:
+            return False
+        edge = node.incoming_edges[0]
+        node = edge.upstream_node
+        label = edge.upstream_label
+        selector = edge.upstream_selector
+    return selector.startswith('a')
+
+
+def _rebuild(downstream_nodes, sorted_nodes, get_incoming_edge_map):
+    """Rebuild the graph upstream-first.
+
+    ``get_incoming_edge_map(node, rebuilt_nodes)`` returns the incoming edge map for
+    the rebuilt copy of ``node``, where ``rebuilt_nodes`` maps each node upstream of
+    ``node`` to its rebuilt copy.  Nodes whose incoming edges stay the same are kept
+    as-is.
+    """
+    rebuilt_nodes = {}
+    for node in sorted_nodes:
+        incoming_edge_map = get_incoming_edge_map(node, rebuilt_nodes)
+        if incoming_edge_map == node.incoming_edge_map:
+            rebuilt_nodes[node] = node
+        else:
+            rebuilt_nodes[node] = node._replace_incoming_edge_map(incoming_edge_map)
+    return [rebuilt_nodes[node] for node in downstream_nodes]
+
+
+def insert_splits(downstream_nodes, sorted_nodes, outgoing_edge_maps, rewrites):
+    """Insert ``split``/``asplit`` filters wherever a filter output feeds more than
+    one downstream node, since ffmpeg only allows each filter output to be consumed
+    once.
+
+    Returns:
+        The new downstream nodes, or ``downstream_nodes`` itself if nothing needed
+        to be split.
+    """
+    split_indices = {}
+    for node in sorted_nodes:
+        if not isinstance(node, FilterNode):
+            continue
+        for downstream_infos in outgoing_edge_maps.get(node, {}).values():
+            if len(downstream_infos) > 1:
+                for index, downstream_info in enumerate(downstream_infos):
+                    downstream_node, downstream_label, _ = downstream_info
+                    split_indices[downstream_node, downstream_label] = index
+    if not split_indices:
+        return downstream_nodes
+
+    split_nodes = {}
+
+    def get_incoming_edge_map(node, rebuilt_nodes):
+        incoming_edge_map = {}
+        for edge in node.incoming_edges:
+            upstream_node = rebuilt_nodes[edge.upstream_node]
+            upstream_label = edge.upstream_label
+            index = split_indices.get((node, edge.downstream_label))
+            if index is not None:
+                key = (upstream_node, upstream_label)
+                if key not in split_nodes:
+                    if _is_audio_stream(
+                        edge.upstream_node, upstream_label, edge.upstream_selector
+                    ):
+                        split_name = 'asplit'
+                    else:
+                        split_name = 'split'
+                    split_nodes[key] = FilterNode(
+                        upstream_node.stream(upstream_label), split_name
+                    )
+                    rewrites.append(
+                        'inserted {} after {!r}'.format(split_name, edge.upstream_node)
+                    )
+                upstream_node = split_nodes[key]
+                upstream_label = index
+            incoming_edge_map[edge.downstream_label] = (
+                upstream_node,
+                upstream_label,
+                edge.upstream_selector,
+            )
+        return incoming_edge_map
+
+    return _rebuild(downstream_nodes, sorted_nodes, get_incoming_edge_map)
+
+
+def _is_noop_filter(node):
+    """Check whether ``node`` is a filter that passes its input through unchanged."""
+    name = node.name
+    args = list(node.args)
+    kwargs = dict(node.kwargs)
+    if name in ('null', 'anull', 'copy', 'acopy'):
+        return not args and not kwargs
+    elif name in ('setpts', 'asetpts'):
+        expr = args if args else [kwargs.pop('expr', None)]
+        return not kwargs and [str(x).replace(' ', '') for x in expr] == ['PTS']
+    elif name in ('trim', 'atrim'):
+        return not args and not kwargs
+    elif name == 'scale':
+        width = args[0] if len(args) > 0 else kwargs.pop('w', kwargs.pop('width', None))
+        height = (
+            args[1] if len(args) > 1 else kwargs.pop('h', kwargs.pop('height', None))
+        )
+        return len(args) <= 2 and not kwargs and (width, height) == ('iw', 'ih')
+    return False
+
+
+def remove_noop_filters(downstream_nodes, sorted_nodes, outgoing_edge_maps, rewrites):
+    """Remove filters that don't do anything, e.g. ``null``, ``setpts=PTS``,
+    ``trim`` without any bounds, or ``scale=iw:ih``.
+
+    Filters fed directly by an input and consumed by an output are kept, since
+    removing them would change which input streams get mapped.
+    """
+    noop_nodes = set()
+    for node in sorted_nodes:
+        if (
+            not isinstance(node, FilterNode)
+            or node in downstream_nodes
+            or len(node.incoming_edges) != 1
+            or not _is_noop_filter(node)
+        ):
+            continue
+        downstream_infos = outgoing_edge_maps.get(node, {})
+        if list(downstream_infos) != [None]:
+            continue
+        upstream_node = node.incoming_edges[0].upstream_node
+        if any(
+            downstream_selector is not None
+            or (
+                isinstance(upstream_node, InputNode)
+                and not isinstance(downstream_node, FilterNode)
+            )
+            for downstream_node, _, downstream_selector in downstream_infos[None]
+        ):
+            continue
+        noop_nodes.add(node)
+    if not noop_nodes:
+        return downstream_nodes
+
+    replacements = {}
+
+    def get_incoming_edge_map(node, rebuilt_nodes):
+        incoming_edge_map = {}
+        for edge in node.incoming_edges:
+            if edge.upstream_node in replacements:
+                upstream_info = replacements[edge.upstream_node]
+            else:
+                upstream_info = (
+                    rebuilt_nodes[edge.upstream_node],
+                    edge.upstream_label,
+                    edge.upstream_selector,
+                )
+            incoming_edge_map[edge.downstream_label] = upstream_info
+        if node in noop_nodes:
+            replacements[node] = incoming_edge_map[
+                node.incoming_edges[0].downstream_label
+            ]
+            rewrites.append('removed no-op filter {!r}'.format(node))
+        return incoming_edge_map
+
+    return _rebuild(downstream_nodes, sorted_nodes, get_incoming_edge_map)
+
+
+# Transformations applied by :meth:`optimize` by default, in order; custom
+# transformations may be added to the list.
+OPTIMIZATIONS = [remove_noop_filters]
+
+
+@output_operator()
+def optimize(stream_spec, rewrites=None, optimizations=None):
+    """Optimize the graph leading up to ``stream_spec``.
+
+    Branches whose output is never mapped to an output are never part of the
+    command line to begin with, and structurally identical filter chains are
+    already merged by :meth:`get_args`.  On top of that, this removes filters that
+    don't do anything, such as ``null``, ``setpts=PTS``, ``trim`` without any bounds
+    or ``scale=iw:ih``.
+
+    Args:
+        rewrites: if a list is supplied, a description of each rewrite that was
+            applied is appended to it (e.g. for logging).
+        optimizations: list of transformations to apply, in order; defaults to
+            ``ffmpeg._transform.OPTIMIZATIONS``.  See the ``_transform`` module
+            for the transformation signature.
+
+    Returns:
+        An optimized stream spec with the same shape as ``stream_spec``.
+
+    Example:
+        ::
+
+            rewrites = []
+            out = ffmpeg.input('in.mp4').setpts('PTS').output('out.mp4')
+            out = out.optimize(rewrites=rewrites)
+            logger.debug('Applied rewrites: %s', rewrites)
+            out.run()
+    """
+    if rewrites is None:
+        rewrites = []
+    if optimizations is None:
+        optimizations = OPTIMIZATIONS
+    stream_map = get_stream_map(stream_spec)
+    nodes = get_stream_map_nodes(stream_map)
+    sorted_nodes, outgoing_edge_maps = topo_sort(nodes)
+    for optimization in optimizations:
+        optimized_nodes = optimization(
+            nodes, sorted_nodes, outgoing_edge_maps, rewrites
+        )
+        if optimized_nodes is not nodes:
+            nodes = optimized_nodes
+            sorted_nodes, outgoing_edge_maps = topo_sort(nodes)
+
+    optimized_stream_map = {
+        key: node.stream(label=stream.label, selector=stream.selector)
+        for node, (key, stream) in zip(nodes, stream_map.items())
+    }
+    if isinstance(stream_spec, Stream):
+        return optimized_stream_map[None]
+    elif isinstance(stream_spec, (list, tuple)):
+        return [optimized_stream_map[i] for i in range(len(stream_spec))]
+    else:
+        return optimized_stream_map
+
+
+__all__ = ['optimize']
@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
-from builtins import str
+from builtins import bytes, str
 from past.builtins import basestring
+from collections import namedtuple, OrderedDict
 import hashlib
+import json
+import numbers
 import sys
+import threading
 
 
 if sys.version_info.major == 2:
@@ -49,34 +53,75 @@ else:
     from builtins import basestring
 
 
-def _recursive_repr(item):
-    """Hack around python `repr` to deterministically represent dictionaries.
+def _canonical_repr(item):
+    """Deterministically represent ``item`` as a string.
 
-    This is able to represent more things than json.dumps, since it does not require
-    things to be JSON serializable (e.g. datetimes).
+    Unlike ``repr``, the result doesn't depend on dictionary ordering or on the Python
+    process (e.g. hash randomization), and unlike ``json.dumps`` it is able to
+    represent things that aren't JSON serializable (e.g. datetimes).  Values are
+    tagged with their type so that e.g. ``1`` and ``'1'`` are represented differently.
     """
-    if isinstance(item, basestring):
-        result = str(item)
-    elif isinstance(item, list):
-        result = '[{}]'.format(', '.join([_recursive_repr(x) for x in item]))
+    if item is None:
+        result = 'n'
+    elif isinstance(item, bool):
+        result = 'b{:d}'.format(item)
+    elif isinstance(item, numbers.Integral):
+        result = 'i{:d}'.format(int(item))
+    elif isinstance(item, float):
+        result = 'f{!r}'.format(float(item))
+    elif sys.version_info.major == 2 and type(item) is type(b''):
+        # Python 2 native strings are text, e.g. filenames in modules that don't
+        # use ``unicode_literals``.
+        result = _canonical_repr(item.decode('utf-8'))
+    elif isinstance(item, basestring) and not isinstance(item, bytes):
+        result = 's{}'.format(json.dumps(item))
+    elif isinstance(item, (list, tuple)):
+        result = '[{}]'.format(','.join([_canonical_repr(x) for x in item]))
     elif isinstance(item, dict):
         kv_pairs = [
-            '{}: {}'.format(_recursive_repr(k), _recursive_repr(item[k]))
+            '{}:{}'.format(_canonical_repr(k), _canonical_repr(item[k]))
             for k in sorted(item)
         ]
-        result = '{' + ', '.join(kv_pairs) + '}'
+        result = '{' + ','.join(kv_pairs) + '}'
+    elif isinstance(item, (set, frozenset)):
+        result = '<{}>'.format(','.join(sorted([_canonical_repr(x) for x in item])))
     else:
-        result = repr(item)
+        result = 'r{}'.format(json.dumps(repr(item)))
     return result
 
 
-def get_hash(item):
-    repr_ = _recursive_repr(item).encode('utf-8')
-    return hashlib.md5(repr_).hexdigest()
+def get_digest(item):
+    """Return a hex digest of ``item`` that is stable across processes and Python
+    versions.
+    """
+    repr_ = _canonical_repr(item).encode('utf-8')
+    return hashlib.sha256(repr_).hexdigest()[:32]
+
 
+def freeze(item):
+    """Convert ``item`` into an equivalent hashable value.
 
-def get_hash_int(item):
-    return int(get_hash(item), base=16)
+    Lists and tuples become tuples, dictionaries become tuples of sorted
+    ``(key, value)`` pairs, and anything else that isn't hashable is represented by
+    its ``repr``.  Non-string values are tagged with their type, since e.g. ``1``,
+    ``1.0`` and ``True`` hash the same but are formatted differently on the ffmpeg
+    command line.
+    """
+    if isinstance(item, (bytes, str)):
+        result = item
+    elif isinstance(item, dict):
+        result = tuple([(k, freeze(item[k])) for k in sorted(item)])
+    elif isinstance(item, (list, tuple)):
+        result = tuple([freeze(x) for x in item])
+    elif isinstance(item, (set, frozenset)):
+        result = frozenset([freeze(x) for x in item])
+    else:
+        try:
+            hash(item)
+            result = (type(item), item)
+        except TypeError:
+            result = (type(item), repr(item))
+    return result
 
 
 def escape_chars(text, chars):
@@ -106,3 +151,60 @@ def convert_kwargs_to_cmd_line_args(kwargs):
         if v is not None:
             args.append('{}'.format(v))
     return args
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError(
+            'failed to import numpy; please make sure numpy is installed (e.g. '
+            '`pip install numpy`)'
+        )
+    return numpy
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LruCache(object):
+    """Bounded, thread-safe least-recently-used cache with hit/miss counters.
+
+    Keys must be hashable.  ``maxsize=0`` disables caching.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key in self.__items:
+                value = self.__items.pop(key)
+                self.__items[key] = value
+                self.hits += 1
+            else:
+                value = default
+                self.misses += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__items.pop(key, None)
+            if self.maxsize > 0:
+                self.__items[key] = value
+                while len(self.__items) > self.maxsize:
+                    self.__items.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.__lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.__items))
@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 
-from ._utils import get_hash, get_hash_int
+from ._utils import freeze, get_digest
 from builtins import object
 from collections import namedtuple
 
@@ -34,12 +34,17 @@ class DagNode(object):
 
     Hashing:
         DagNodes must be hashable, and two nodes are considered to be equivalent if
-        they have the same hash value.
+        they have the same contents and the same upstream graph (in which case they
+        also have the same hash value; the converse doesn't hold).
 
         Nodes are immutable, and the hash should remain constant as a result.  If a
         node with new contents is required, create a new node and throw the old one
         away.
 
+        The hash is only meaningful within a single Python process.  Implementations
+        may additionally provide a ``digest`` method returning a hash that is stable
+        across processes (e.g. for keying on-disk caches).
+
     String representation:
         In order for graph visualization tools to show useful information, nodes must
         be representable as strings.  The ``repr`` operator should provide a more or
@@ -50,13 +55,15 @@ class DagNode(object):
         constant.
     """
 
+    __slots__ = ()
+
     def __hash__(self):
         """Return an integer hash of the node."""
         raise NotImplementedError()
 
     def __eq__(self, other):
         """Compare two nodes; implementations should return True if (and only if)
-        hashes match.
+        the nodes are structurally identical, which implies that their hashes match.
         """
         raise NotImplementedError()
 
@@ -96,7 +103,7 @@ def get_incoming_edges(downstream_node, incoming_edge_map):
     edges = []
     for downstream_label, upstream_info in list(incoming_edge_map.items()):
         upstream_node, upstream_label, upstream_selector = upstream_info
-        edges += [
+        edges.append(
             DagEdge(
                 downstream_node,
                 downstream_label,
@@ -104,7 +111,7 @@ def get_incoming_edges(downstream_node, incoming_edge_map):
                 upstream_label,
                 upstream_selector,
             )
-        ]
+        )
     return edges
 
 
@@ -113,7 +120,7 @@ def get_outgoing_edges(upstream_node, outgoing_edge_map):
     for upstream_label, downstream_infos in sorted(outgoing_edge_map.items()):
         for downstream_info in downstream_infos:
             downstream_node, downstream_label, downstream_selector = downstream_info
-            edges += [
+            edges.append(
                 DagEdge(
                     downstream_node,
                     downstream_label,
@@ -121,54 +128,169 @@ def get_outgoing_edges(upstream_node, outgoing_edge_map):
                     upstream_label,
                     downstream_selector,
                 )
-            ]
+            )
     return edges
 
 
+def _get_slot_names(cls):
+    """Get the (mangled) attribute names of the ``__slots__`` of ``cls`` and its
+    bases.
+    """
+    names = []
+    for base in cls.__mro__:
+        for name in base.__dict__.get('__slots__', ()):
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_{}{}'.format(base.__name__.lstrip('_'), name)
+            names.append(name)
+    return names
+
+
+# Shared by all nodes without args/kwargs so that each node doesn't carry its own
+# empty containers; like everything else about a node, these must not be mutated.
+_EMPTY_ARGS = ()
+_EMPTY_KWARGS = {}
+
+
 class KwargReprNode(DagNode):
     """A DagNode that can be represented as a set of args+kwargs."""
 
-    @property
-    def __upstream_hashes(self):
-        hashes = []
-        for downstream_label, upstream_info in list(self.incoming_edge_map.items()):
-            upstream_node, upstream_label, upstream_selector = upstream_info
-            hashes += [
-                hash(x)
-                for x in [
-                    downstream_label,
-                    upstream_node,
-                    upstream_label,
-                    upstream_selector,
-                ]
-            ]
-        return hashes
-
-    @property
-    def __inner_hash(self):
-        props = {'args': self.args, 'kwargs': self.kwargs}
-        return get_hash(props)
+    __slots__ = (
+        '__incoming_edge_map',
+        '__incoming_edges',
+        '__hash',
+        '__digest',
+        'name',
+        'args',
+        'kwargs',
+    )
 
     def __get_hash(self):
-        hashes = self.__upstream_hashes + [self.__inner_hash]
-        return get_hash_int(hashes)
+        upstream_infos = tuple(
+            (downstream_label,) + tuple(upstream_info)
+            for downstream_label, upstream_info in self.incoming_edge_map.items()
+        )
+        props = (self.name, freeze(self.args), freeze(self.kwargs), upstream_infos)
+        return hash(props)
 
     def __init__(self, incoming_edge_map, name, args, kwargs):
         self.__incoming_edge_map = incoming_edge_map
+        self.__incoming_edges = None
         self.name = name
-        self.args = args
-        self.kwargs = kwargs
+        self.args = args or _EMPTY_ARGS
+        self.kwargs = kwargs or _EMPTY_KWARGS
+        self.__hash = self.__get_hash()
+        self.__digest = None
+
+    def __getstate__(self):
+        # The hash, digest and incoming edges are derived from the rest of the node,
+        # and recomputed when unpickling, since the hash of strings differs between
+        # processes.
+        derived_names = {
+            '_KwargReprNode__hash',
+            '_KwargReprNode__digest',
+            '_KwargReprNode__incoming_edges',
+        }
+        return {
+            name: getattr(self, name)
+            for name in _get_slot_names(type(self))
+            if name not in derived_names and hasattr(self, name)
+        }
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.__incoming_edges = None
         self.__hash = self.__get_hash()
+        self.__digest = None
 
     def __hash__(self):
         return self.__hash
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        # The hash only rules nodes out: e.g. ``hash(-1) == hash(-2)``, so nodes that
+        # hash the same are compared structurally.  Upstream nodes are compared with
+        # an explicit stack so that long filter chains don't hit the recursion limit.
+        stack = [(self, other)]
+        seen = set()
+        while stack:
+            node, other_node = stack.pop()
+            if node is other_node or (id(node), id(other_node)) in seen:
+                continue
+            seen.add((id(node), id(other_node)))
+            if (
+                type(node) is not type(other_node)
+                or hash(node) != hash(other_node)
+                or node.name != other_node.name
+                or freeze(node.args) != freeze(other_node.args)
+                or freeze(node.kwargs) != freeze(other_node.kwargs)
+            ):
+                return False
+            edge_map = node.incoming_edge_map
+            other_edge_map = other_node.incoming_edge_map
+            if set(edge_map) != set(other_edge_map):
+                return False
+            for downstream_label, upstream_info in edge_map.items():
+                upstream_node, upstream_label, upstream_selector = upstream_info
+                (
+                    other_upstream_node,
+                    other_upstream_label,
+                    other_upstream_selector,
+                ) = other_edge_map[downstream_label]
+                if (upstream_label, upstream_selector) != (
+                    other_upstream_label,
+                    other_upstream_selector,
+                ):
+                    return False
+                stack.append((upstream_node, other_upstream_node))
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __get_digest(self):
+        upstream_infos = [
+            [
+                downstream_label,
+                upstream_node.__digest,
+                upstream_label,
+                upstream_selector,
+            ]
+            for downstream_label, (
+                upstream_node,
+                upstream_label,
+                upstream_selector,
+            ) in self.incoming_edge_map.items()
+        ]
+        return get_digest([self.name, self.args, self.kwargs, upstream_infos])
+
+    def digest(self):
+        """Return a hex digest of the node and everything upstream of it.
+
+        Unlike ``hash(node)``, the digest is stable across processes and Python
+        versions, so it may be used to key on-disk caches, deduplicate jobs across
+        machines, etc.  It's computed on first use and then memoized.
+        """
+        stack = [self]
+        while stack:
+            node = stack[-1]
+            pending_nodes = [
+                upstream_node
+                for upstream_node, _, _ in node.incoming_edge_map.values()
+                if upstream_node.__digest is None
+            ]
+            if pending_nodes:
+                stack += pending_nodes
+            else:
+                if node.__digest is None:
+                    node.__digest = node.__get_digest()
+                stack.pop()
+        return self.__digest
 
     @property
     def short_hash(self):
-        return '{:x}'.format(abs(hash(self)))[:12]
+        # Derived from the digest rather than the hash, so that it's the same in
+        # every process (e.g. in logs and graph visualizations).
+        return self.digest()[:12]
 
     def long_repr(self, include_hash=True):
         formatted_props = ['{!r}'.format(arg) for arg in self.args]
@@ -185,7 +307,11 @@ class KwargReprNode(DagNode):
 
     @property
     def incoming_edges(self):
-        return get_incoming_edges(self, self.incoming_edge_map)
+        if self.__incoming_edges is None:
+            self.__incoming_edges = tuple(
+                get_incoming_edges(self, self.incoming_edge_map)
+            )
+        return self.__incoming_edges
 
     @property
     def incoming_edge_map(self):
@@ -197,44 +323,53 @@ class KwargReprNode(DagNode):
 
 
 def topo_sort(downstream_nodes):
-    marked_nodes = []
+    """Topologically sort the graph leading up to ``downstream_nodes``.
+
+    The graph is walked depth-first with an explicit stack rather than recursion so
+    that very long filter chains don't hit the interpreter's recursion limit, and
+    visited nodes are tracked in sets so that the whole sort is linear in the number
+    of nodes and edges.
+
+    Returns:
+        A ``(sorted_nodes, outgoing_edge_maps)`` tuple, where ``sorted_nodes`` lists
+        every node upstream-first, and ``outgoing_edge_maps`` maps each node to a
+        dictionary of ``upstream_label`` -> list of
+        ``(downstream_node, downstream_label, downstream_selector)`` tuples.
+    """
+    marked_nodes = set()
+    sorted_node_set = set()
     sorted_nodes = []
     outgoing_edge_maps = {}
+    stack = []
 
-    def visit(
-        upstream_node,
-        upstream_label,
-        downstream_node,
-        downstream_label,
-        downstream_selector=None,
-    ):
+    def visit(upstream_node):
         if upstream_node in marked_nodes:
             raise RuntimeError('Graph is not a DAG')
-
-        if downstream_node is not None:
-            outgoing_edge_map = outgoing_edge_maps.get(upstream_node, {})
-            outgoing_edge_infos = outgoing_edge_map.get(upstream_label, [])
-            outgoing_edge_infos += [
-                (downstream_node, downstream_label, downstream_selector)
-            ]
-            outgoing_edge_map[upstream_label] = outgoing_edge_infos
-            outgoing_edge_maps[upstream_node] = outgoing_edge_map
-
-        if upstream_node not in sorted_nodes:
-            marked_nodes.append(upstream_node)
-            for edge in upstream_node.incoming_edges:
-                visit(
-                    edge.upstream_node,
-                    edge.upstream_label,
-                    edge.downstream_node,
-                    edge.downstream_label,
-                    edge.upstream_selector,
+        if upstream_node not in sorted_node_set:
+            marked_nodes.add(upstream_node)
+            stack.append((upstream_node, iter(upstream_node.incoming_edges)))
+
+    for downstream_node in reversed(downstream_nodes):
+        visit(downstream_node)
+        while stack:
+            node, incoming_edges = stack[-1]
+            for edge in incoming_edges:
+                outgoing_edge_map = outgoing_edge_maps.setdefault(
+                    edge.upstream_node, {}
                 )
-            marked_nodes.remove(upstream_node)
-            sorted_nodes.append(upstream_node)
-
-    unmarked_nodes = [(node, None) for node in downstream_nodes]
-    while unmarked_nodes:
-        upstream_node, upstream_label = unmarked_nodes.pop()
-        visit(upstream_node, upstream_label, None, None)
+                outgoing_edge_map.setdefault(edge.upstream_label, []).append(
+                    (
+                        edge.downstream_node,
+                        edge.downstream_label,
+                        edge.upstream_selector,
+                    )
+                )
+                visit(edge.upstream_node)
+                if stack[-1][0] is not node:
+                    break
+            else:
+                stack.pop()
+                marked_nodes.remove(node)
+                sorted_node_set.add(node)
+                sorted_nodes.append(node)
     return sorted_nodes, outgoing_edge_maps
@@ -2,7 +2,7 @@ from __future__ import unicode_literals
 
 from past.builtins import basestring
 from .dag import KwargReprNode
-from ._utils import escape_chars, get_hash_int
+from ._utils import escape_chars, get_digest
 from builtins import object
 import os
 
@@ -25,6 +25,8 @@ class Stream(object):
     downstream nodes.
     """
 
+    __slots__ = ('node', 'label', 'selector', '__hash', '__digest')
+
     def __init__(
         self, upstream_node, upstream_label, node_types, upstream_selector=None
     ):
@@ -37,12 +39,45 @@ class Stream(object):
         self.node = upstream_node
         self.label = upstream_label
         self.selector = upstream_selector
+        self.__hash = hash((self.node, self.label, self.selector))
+        self.__digest = None
+
+    def __getstate__(self):
+        return {'node': self.node, 'label': self.label, 'selector': self.selector}
+
+    def __setstate__(self, state):
+        # The hash is recomputed, since the hash of strings differs between
+        # processes.
+        self.node = state['node']
+        self.label = state['label']
+        self.selector = state['selector']
+        self.__hash = hash((self.node, self.label, self.selector))
+        self.__digest = None
 
     def __hash__(self):
-        return get_hash_int([hash(self.node), hash(self.label)])
+        return self.__hash
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        if self is other:
+            return True
+        if not isinstance(other, Stream) or hash(self) != hash(other):
+            return False
+        return (self.node, self.label, self.selector) == (
+            other.node,
+            other.label,
+            other.selector,
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def digest(self):
+        """Return a hex digest of the stream that is stable across processes and
+        Python versions; see :meth:`KwargReprNode.digest`.
+        """
+        if self.__digest is None:
+            self.__digest = get_digest([self.node.digest(), self.label, self.selector])
+        return self.__digest
 
     def __repr__(self):
         node_repr = self.node.long_repr(include_hash=False)
@@ -152,6 +187,8 @@ def get_stream_spec_nodes(stream_spec):
 class Node(KwargReprNode):
     """Node base"""
 
+    __slots__ = ('__outgoing_stream_type',)
+
     @classmethod
     def __check_input_len(cls, stream_map, min_inputs, max_inputs):
         if min_inputs is not None and len(stream_map) < min_inputs:
@@ -206,7 +243,6 @@ class Node(KwargReprNode):
 
         super(Node, self).__init__(incoming_edge_map, name, args, kwargs)
         self.__outgoing_stream_type = outgoing_stream_type
-        self.__incoming_stream_types = incoming_stream_types
 
     def stream(self, label=None, selector=None):
         """Create an outgoing stream originating from this node.
@@ -215,6 +251,19 @@ class Node(KwargReprNode):
         """
         return self.__outgoing_stream_type(self, label, upstream_selector=selector)
 
+    def _replace_incoming_edge_map(self, incoming_edge_map):
+        """Create a copy of this node with a different incoming edge map.
+
+        Nodes are immutable, so graph transformations use this to rebuild the nodes
+        downstream of whatever they change.
+        """
+        node = object.__new__(type(self))
+        node.__outgoing_stream_type = self.__outgoing_stream_type
+        KwargReprNode.__init__(
+            node, incoming_edge_map, self.name, self.args, self.kwargs
+        )
+        return node
+
     def __getitem__(self, item):
         """Create an outgoing stream originating from this node; syntactic sugar for
         ``self.stream(label)``.  It can also be used to apply a selector: e.g.
@@ -236,6 +285,8 @@ class Node(KwargReprNode):
 
 
 class FilterableStream(Stream):
+    __slots__ = ()
+
     def __init__(self, upstream_node, upstream_label, upstream_selector=None):
         super(FilterableStream, self).__init__(
             upstream_node, upstream_label, {InputNode, FilterNode}, upstream_selector
@@ -246,6 +297,8 @@ class FilterableStream(Stream):
 class InputNode(Node):
     """InputNode type"""
 
+    __slots__ = ()
+
     def __init__(self, name, args=[], kwargs={}):
         super(InputNode, self).__init__(
             stream_spec=None,
@@ -265,6 +318,8 @@ class InputNode(Node):
 
 # noinspection PyMethodOverriding
 class FilterNode(Node):
+    __slots__ = ()
+
     def __init__(self, stream_spec, name, max_inputs=1, args=[], kwargs={}):
         super(FilterNode, self).__init__(
             stream_spec=stream_spec,
@@ -305,6 +360,8 @@ class FilterNode(Node):
 
 # noinspection PyMethodOverriding
 class OutputNode(Node):
+    __slots__ = ()
+
     def __init__(self, stream, name, args=[], kwargs={}):
         super(OutputNode, self).__init__(
             stream_spec=stream,
@@ -323,6 +380,8 @@ class OutputNode(Node):
 
 
 class OutputStream(Stream):
+    __slots__ = ()
+
     def __init__(self, upstream_node, upstream_label, upstream_selector=None):
         super(OutputStream, self).__init__(
             upstream_node,
@@ -334,6 +393,8 @@ class OutputStream(Stream):
 
 # noinspection PyMethodOverriding
 class MergeOutputsNode(Node):
+    __slots__ = ()
+
     def __init__(self, streams, name):
         super(MergeOutputsNode, self).__init__(
             stream_spec=streams,
@@ -347,6 +408,8 @@ class MergeOutputsNode(Node):
 
 # noinspection PyMethodOverriding
 class GlobalNode(Node):
+    __slots__ = ()
+
     def __init__(self, stream, name, args=[], kwargs={}):
         super(GlobalNode, self).__init__(
             stream_spec=stream,
@@ -2,13 +2,21 @@ from __future__ import unicode_literals
 from builtins import bytes
 from builtins import range
 from builtins import str
+import binascii
+import collections
+import json
+import math
 import ffmpeg
+import multiprocessing
 import os
+import pickle
 import pytest
 import random
 import re
 import subprocess
 import sys
+import threading
+import time
 
 
 try:
@@ -54,6 +62,103 @@ def test_fluent_equality():
     assert t1 != t5
 
 
+def test_fluent_equality__filter_name_and_selector():
+    base = ffmpeg.input('dummy1.mp4')
+    assert base.hflip() == ffmpeg.input('dummy1.mp4').hflip()
+    assert base.hflip() != base.vflip()
+    assert base.hflip().node != base.vflip().node
+    assert base['a'] == ffmpeg.input('dummy1.mp4')['a']
+    assert base['a'] != base['v']
+    assert base.filter('scale', size=[1, 2]) == base.filter('scale', size=[1, 2])
+    assert base.filter('scale', size=[1, 2]) != base.filter('scale', size=[2, 1])
+
+
+def test_fluent_equality__hash_collision():
+    # `hash(-1) == hash(-2)` in CPython, so these nodes hash the same.
+    base = ffmpeg.input('in.mp4')
+    scaled1 = base.filter('scale', 640, -1)
+    scaled2 = base.filter('scale', 640, -2)
+    assert scaled1 != scaled2
+    assert scaled1.node != scaled2.node
+    assert scaled1.output('out.mp4') != scaled2.output('out.mp4')
+    assert scaled1.output('out.mp4') == base.filter('scale', 640, -1).output('out.mp4')
+    out1 = base.output('out.mp4', crf=-1)
+    out2 = base.output('out.mp4', crf=-2)
+    assert out1 != out2
+    assert out1.node != out2.node
+    assert len({scaled1, scaled2, out1, out2}) == 4
+
+
+def test_digest():
+    out1 = ffmpeg.input('in.mp4').filter('scale', 320, -1).output('out.mp4')
+    out2 = ffmpeg.input('in.mp4').filter('scale', 320, -1).output('out.mp4')
+    out3 = ffmpeg.input('in.mp4').filter('scale', '320', -1).output('out.mp4')
+    assert out1.digest() == out2.digest()
+    assert out1.node.digest() == out2.node.digest()
+    assert out1.digest() != out3.digest()
+    assert out1.digest() != out1.node.digest()
+    assert len(out1.digest()) == 32
+
+
+def test_digest__stable_across_processes():
+    code = (
+        'import ffmpeg; '
+        'print(ffmpeg.input("in.mp4").hflip().output("out.mp4", t=10).digest())'
+    )
+    digests = set()
+    for hash_seed in ['1', '2']:
+        env = dict(
+            os.environ,
+            PYTHONHASHSEED=hash_seed,
+            PYTHONPATH=os.path.dirname(os.path.dirname(ffmpeg.__file__)),
+        )
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        digests.add(out.decode().strip())
+    assert digests == {ffmpeg.input('in.mp4').hflip().output('out.mp4', t=10).digest()}
+
+
+def test_pickle__across_processes():
+    code = (
+        'import binascii, ffmpeg, pickle, sys; '
+        'out = ffmpeg.input("in.mp4").hflip().output("out1.mp4"); '
+        'sys.stdout.write(binascii.hexlify(pickle.dumps(out, {})).decode())'
+    )
+    local_out = ffmpeg.input('in.mp4').hflip().output('out1.mp4')
+    for protocol in [0, 2]:
+        env = dict(
+            os.environ,
+            PYTHONHASHSEED='1',
+            PYTHONPATH=os.path.dirname(os.path.dirname(ffmpeg.__file__)),
+        )
+        data = subprocess.check_output(
+            [sys.executable, '-c', code.format(protocol)], env=env
+        )
+        out = pickle.loads(binascii.unhexlify(data))
+        assert out == local_out
+        assert hash(out) == hash(local_out)
+        assert out.node.short_hash == local_out.node.short_hash
+        args = ffmpeg.merge_outputs(
+            out, ffmpeg.input('in.mp4').hflip().output('out2.mp4')
+        ).get_args()
+        assert args == [
+            '-i',
+            'in.mp4',
+            '-filter_complex',
+            '[0]hflip,split=2[s0][s1]',
+            '-map',
+            '[s0]',
+            'out1.mp4',
+            '-map',
+            '[s1]',
+            'out2.mp4',
+        ]
+
+
+def test_short_hash():
+    node = ffmpeg.input('in.mp4').hflip().node
+    assert node.short_hash == node.digest()[:12]
+
+
 def test_fluent_concat():
     base = ffmpeg.input('dummy.mp4')
     trimmed1 = base.trim(start_frame=10, end_frame=20)
@@ -104,6 +209,18 @@ def test_node_repr():
     )
 
 
+def test_node_incoming_edges():
+    in_file = ffmpeg.input('dummy.mp4')
+    overlay = in_file.overlay(ffmpeg.input('dummy.png'))
+    edges = overlay.node.incoming_edges
+    assert edges is overlay.node.incoming_edges
+    assert [edge.upstream_node.short_repr for edge in edges] == [
+        'dummy.mp4',
+        'dummy.png',
+    ]
+    assert in_file.node.incoming_edges == ()
+
+
 def test_stream_repr():
     in_file = ffmpeg.input('dummy.mp4')
     assert repr(in_file) == 'input(filename={!r})[None] <{}>'.format(
@@ -184,22 +301,91 @@ def test__get_args__complex_filter():
         '-i',
         TEST_OVERLAY_FILE,
         '-filter_complex',
-        '[0]vflip[s0];'
-        '[s0]split=2[s1][s2];'
-        '[s1]trim=end_frame=20:start_frame=10[s3];'
-        '[s2]trim=end_frame=40:start_frame=30[s4];'
-        '[s3][s4]concat=n=2[s5];'
-        '[1]crop=158:112:10:10[s6];'
-        '[s6]hflip[s7];'
-        '[s5][s7]overlay=eof_action=repeat[s8];'
-        '[s8]drawbox=50:50:120:120:red:t=5[s9]',
-        '-map',
-        '[s9]',
+        '[0]vflip,split=2[s0][s1];'
+        '[s0]trim=end_frame=20:start_frame=10[s2];'
+        '[s1]trim=end_frame=40:start_frame=30[s3];'
+        '[s2][s3]concat=n=2[s4];'
+        '[1]crop=158:112:10:10,hflip[s5];'
+        '[s4][s5]overlay=eof_action=repeat,drawbox=50:50:120:120:red:t=5[s6]',
+        '-map',
+        '[s6]',
         TEST_OUTPUT_FILE1,
         '-y',
     ]
 
 
+def test__get_args__many_inputs_and_outputs():
+    count = 500
+    outputs = [
+        ffmpeg.input('in{}.mp4'.format(i)).output('out{}.mp4'.format(i))
+        for i in range(count)
+    ]
+    args = ffmpeg.merge_outputs(*outputs).get_args()
+    assert args[: 2 * count] == [
+        x for i in range(count) for x in ['-i', 'in{}.mp4'.format(i)]
+    ]
+    assert args[2 * count : 2 * count + 4] == ['out0.mp4', '-map', '1', 'out1.mp4']
+    assert args[-3:] == ['-map', str(count - 1), 'out{}.mp4'.format(count - 1)]
+
+
+def test__get_args__cache():
+    ffmpeg.get_args.cache_clear()
+    out1 = _get_complex_filter_example()
+    out2 = _get_complex_filter_example()
+    args = ffmpeg.get_args(out1)
+    assert ffmpeg.get_args.cache_info() == (0, 1, 128, 1)
+    assert out2.get_args() == args
+    assert ffmpeg.get_args.cache_info() == (1, 1, 128, 1)
+    ffmpeg.get_args(out1).append('-y')
+    assert ffmpeg.get_args(out1) == args
+    assert ffmpeg.get_args(out1, overwrite_output=True) == args + ['-y']
+    assert ffmpeg.get_args.cache_info() == (3, 2, 128, 2)
+    ffmpeg.get_args.cache_clear()
+    assert ffmpeg.get_args.cache_info() == (0, 0, 128, 0)
+
+
+def test__get_args__cache__hash_collision():
+    # `hash(-1) == hash(-2)` in CPython, so these graphs hash the same.
+    ffmpeg.get_args.cache_clear()
+    assert ffmpeg.input('x').output('o.mp4', crf=-1).get_args() == [
+        '-i',
+        'x',
+        '-crf',
+        '-1',
+        'o.mp4',
+    ]
+    assert ffmpeg.input('x').output('o.mp4', crf=-2).get_args() == [
+        '-i',
+        'x',
+        '-crf',
+        '-2',
+        'o.mp4',
+    ]
+    ffmpeg.input('x').filter('scale', 640, -1).output('a.mp4').get_args()
+    assert ffmpeg.input('x').filter('scale', 640, -2).output('a.mp4').get_args() == [
+        '-i',
+        'x',
+        '-filter_complex',
+        '[0]scale=640:-2[s0]',
+        '-map',
+        '[s0]',
+        'a.mp4',
+    ]
+    assert ffmpeg.get_args.cache_info().hits == 0
+
+
+def test_lru_cache():
+    cache = ffmpeg._utils.LruCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.info() == (3, 1, 2, 2)
+
+
 def test_combined_output():
     i1 = ffmpeg.input(TEST_INPUT_FILE1)
     i2 = ffmpeg.input(TEST_OVERLAY_FILE)
@@ -271,6 +457,173 @@ def _get_complex_filter_asplit_example():
     )
 
 
+def test__get_args__auto_split():
+    in_file = ffmpeg.input('in.mp4')
+    video = in_file.video.hflip()
+    audio = in_file.audio.filter('aecho', 0.8, 0.9, 1000, 0.3)
+    out1 = ffmpeg.output(video.filter('scale', 640, -1), audio, 'out1.mp4')
+    out2 = ffmpeg.output(video.filter('scale', 320, -1), audio, 'out2.mp4')
+    assert ffmpeg.merge_outputs(out1, out2).get_args() == [
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0:v]hflip,split=2[s0][s1];'
+        '[s0]scale=640:-1[s2];'
+        '[0:a]aecho=0.8:0.9:1000:0.3,asplit=2[s3][s4];'
+        '[s1]scale=320:-1[s5]',
+        '-map',
+        '[s2]',
+        '-map',
+        '[s3]',
+        'out1.mp4',
+        '-map',
+        '[s5]',
+        '-map',
+        '[s4]',
+        'out2.mp4',
+    ]
+
+
+def test__get_args__auto_split__same_node():
+    flipped = ffmpeg.input('in.mp4').hflip()
+    args = ffmpeg.overlay(flipped, flipped).output('out.mp4').get_args()
+    assert args[args.index('-filter_complex') + 1] == (
+        '[0]hflip,split=2[s0][s1];' '[s0][s1]overlay=eof_action=repeat[s2]'
+    )
+
+
+def test__get_args__auto_split__concat_audio():
+    in_file = ffmpeg.input('in.mp4')
+    joined = ffmpeg.concat(in_file.video, in_file.audio, v=1, a=1).node
+    out1 = ffmpeg.output(joined[0], joined[1], 'out1.mp4')
+    out2 = ffmpeg.output(joined[1], 'out2.mp3')
+    args = ffmpeg.merge_outputs(out1, out2).get_args()
+    assert args[args.index('-filter_complex') + 1] == (
+        '[0:v][0:a]concat=a=1:n=1:v=1[s0][s1];[s1]asplit=2[s2][s3]'
+    )
+
+
+def test__get_args__auto_split__audio_to_video():
+    waves = ffmpeg.input('in.mp3').audio.filter('showwaves')
+    args = ffmpeg.merge_outputs(
+        waves.output('out1.mp4'), waves.hflip().output('out2.mp4')
+    ).get_args()
+    assert args[args.index('-filter_complex') + 1] == (
+        '[0:a]showwaves,split=2[s0][s1];[s1]hflip[s2]'
+    )
+
+
+def test__run__auto_split():
+    flipped = ffmpeg.input(TEST_INPUT_FILE1).video.hflip()
+    ffmpeg.run(
+        [flipped.output(TEST_OUTPUT_FILE1), flipped.output(TEST_OUTPUT_FILE2)],
+        overwrite_output=True,
+        capture_stdout=True,
+        capture_stderr=True,
+    )
+
+
+def test__get_args__duplicate_chains():
+    def get_chain(width):
+        return ffmpeg.input('in.mp4').filter('scale', width, -1).hflip()
+
+    out = ffmpeg.merge_outputs(
+        get_chain(320).output('out1.mp4'),
+        get_chain(320).output('out2.mp4'),
+        get_chain(320.0).output('out3.mp4'),
+    )
+    assert out.get_args() == [
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0]scale=320:-1,hflip,split=2[s0][s1];' '[0]scale=320.0:-1,hflip[s2]',
+        '-map',
+        '[s0]',
+        'out1.mp4',
+        '-map',
+        '[s1]',
+        'out2.mp4',
+        '-map',
+        '[s2]',
+        'out3.mp4',
+    ]
+
+    # `hash(-1) == hash(-2)` in CPython, but these chains differ.
+    in_file = ffmpeg.input('in.mp4')
+    out = ffmpeg.concat(
+        in_file.filter('eq', brightness=-1), in_file.filter('eq', brightness=-2)
+    ).output('out.mp4')
+    assert out.get_args() == [
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0]eq=brightness=-1[s0];[0]eq=brightness=-2[s1];[s0][s1]concat=n=2[s2]',
+        '-map',
+        '[s2]',
+        'out.mp4',
+    ]
+
+
+def test__optimize():
+    in_file = ffmpeg.input('in.mp4')
+    out = (
+        in_file.video.hflip()
+        .setpts('PTS')
+        .filter('null')
+        .trim()
+        .filter('scale', 'iw', 'ih')
+        .filter('scale', w='iw', h='ih')
+        .vflip()
+        .output('out.mp4')
+    )
+    rewrites = []
+    optimized = out.optimize(rewrites=rewrites)
+    assert optimized.get_args() == [
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0:v]hflip,vflip[s0]',
+        '-map',
+        '[s0]',
+        'out.mp4',
+    ]
+    assert [x.split('(')[0] for x in rewrites] == [
+        'removed no-op filter setpts',
+        'removed no-op filter null',
+        'removed no-op filter trim',
+        'removed no-op filter scale',
+        'removed no-op filter scale',
+    ]
+
+
+def test__optimize__keeps_filters():
+    in_file = ffmpeg.input('in.mp4')
+    outputs = [
+        in_file.filter('null').output('out1.mp4'),
+        in_file.setpts('2*PTS').output('out2.mp4'),
+        in_file.trim(start_frame=10).output('out3.mp4'),
+        in_file.filter('scale', 'iw', 'ih', flags='bicubic').output('out4.mp4'),
+    ]
+    rewrites = []
+    assert ffmpeg.optimize(outputs, rewrites=rewrites) == outputs
+    assert rewrites == []
+
+
+def test__optimize__custom():
+    def replace_input(downstream_nodes, sorted_nodes, outgoing_edge_maps, rewrites):
+        rewrites.append('custom')
+        return [
+            ffmpeg.input('other.mp4').output(node.kwargs['filename']).node
+            for node in downstream_nodes
+        ]
+
+    rewrites = []
+    out = ffmpeg.input('in.mp4').hflip().output('out.mp4')
+    optimized = out.optimize(rewrites=rewrites, optimizations=[replace_input])
+    assert optimized.get_args() == ['-i', 'other.mp4', 'out.mp4']
+    assert rewrites == ['custom']
+
+
 def test_filter_concat__video_only():
     in1 = ffmpeg.input('in1.mp4')
     in2 = ffmpeg.input('in2.mp4')
@@ -344,14 +697,13 @@ def test_filter_asplit():
         TEST_INPUT_FILE1,
         '-filter_complex',
         (
-            '[0]vflip[s0];'
-            '[s0]asplit=2[s1][s2];'
-            '[s1]atrim=end=20:start=10[s3];'
-            '[s2]atrim=end=40:start=30[s4];'
-            '[s3][s4]concat=n=2[s5]'
+            '[0]vflip,asplit=2[s0][s1];'
+            '[s0]atrim=end=20:start=10[s2];'
+            '[s1]atrim=end=40:start=30[s3];'
+            '[s2][s3]concat=n=2[s4]'
         ),
         '-map',
-        '[s5]',
+        '[s4]',
         TEST_OUTPUT_FILE1,
         '-y',
     ]
@@ -464,6 +816,52 @@ def test__compile():
     ]
 
 
+def test__compile__filter_complex_script():
+    stream = _get_complex_filter_example()
+    args = ffmpeg.get_args(stream)
+    filter_arg = args[args.index('-filter_complex') + 1]
+    assert stream.compile(filter_complex_script=None) == ['ffmpeg'] + args
+
+    script_args = stream.compile(filter_complex_script=True)
+    index = script_args.index('-filter_complex_script')
+    script_filename = script_args[index + 1]
+    try:
+        with open(script_filename, 'rb') as f:
+            assert f.read().decode('utf-8') == filter_arg
+    finally:
+        os.remove(script_filename)
+    assert script_args[:index] + script_args[index + 2 :] == [
+        x for x in ['ffmpeg'] + args if x not in ['-filter_complex', filter_arg]
+    ]
+
+
+def test__compile__filter_complex_script__threshold():
+    stream = ffmpeg.input('dummy.mp4')
+    for _ in range(ffmpeg._run.FILTER_COMPLEX_SCRIPT_THRESHOLD // 5):
+        stream = stream.hflip()
+    args = stream.output('dummy2.mp4').compile(filter_complex_script=None)
+    assert '-filter_complex' not in args
+    os.remove(args[args.index('-filter_complex_script') + 1])
+
+
+def test__run__filter_complex_script(mocker):
+    spill_filter_complex = ffmpeg._run._spill_filter_complex
+    spilled = []
+
+    def _spill(*args, **kwargs):
+        spilled.append(spill_filter_complex(*args, **kwargs))
+        return spilled[-1]
+
+    mocker.patch.object(ffmpeg._run, '_spill_filter_complex', side_effect=_spill)
+    stream = _get_complex_filter_example()
+    ffmpeg.run(
+        stream, filter_complex_script=True, capture_stdout=True, capture_stderr=True
+    )
+    args, script_filename = spilled[-1]
+    assert args[args.index('-filter_complex_script') + 1] == script_filename
+    assert not os.path.exists(script_filename)
+
+
 @pytest.mark.parametrize('pipe_stdin', [True, False])
 @pytest.mark.parametrize('pipe_stdout', [True, False])
 @pytest.mark.parametrize('pipe_stderr', [True, False])
@@ -819,3 +1217,1119 @@ def test__multi_output_edge_label_order():
     out1, out2 = get_filter_complex_outputs(flt_cmpl, 'scale2ref')
     assert out1 == get_filter_complex_input(flt_cmpl, 'scale')
     assert out2 == get_filter_complex_input(flt_cmpl, 'hflip')
+
+
+def test__get_args__filter_chains():
+    in_file = ffmpeg.input('in.mp4')
+    overlay = in_file.crop(0, 0, 100, 100).hflip().overlay(in_file['v'].vflip())
+    out = ffmpeg.output(overlay.hue(s=0), in_file['a'].filter('anull'), 'out.mp4')
+    assert out.get_args() == [
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0]crop=100:100:0:0,hflip[s0];'
+        '[0:v]vflip[s1];'
+        '[s0][s1]overlay=eof_action=repeat,hue=s=0[s2];'
+        '[0:a]anull[s3]',
+        '-map',
+        '[s2]',
+        '-map',
+        '[s3]',
+        'out.mp4',
+    ]
+
+
+def test__get_args__long_chain():
+    stream = ffmpeg.input('dummy.mp4')
+    for _ in range(10000):
+        stream = stream.hflip()
+    args = stream.output('dummy2.mp4').get_args()
+    flt_cmpl = args[args.index('-filter_complex') + 1]
+    assert flt_cmpl == '[0]{}[s0]'.format(','.join(['hflip'] * 10000))
+    assert args[-3:] == ['-map', '[s0]', 'dummy2.mp4']
+
+
+def _get_frames_example():
+    return ffmpeg.input(TEST_INPUT_FILE1).filter('scale', 32, 24)
+
+
+def test__frames():
+    expected, _ = (
+        _get_frames_example()
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24', an=None)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    frames = []
+    for frame in _get_frames_example().frames(width=32, height=24, loglevel='error'):
+        assert isinstance(frame, memoryview)
+        assert len(frame) == 32 * 24 * 3
+        frames.append(frame.tobytes())
+    assert b''.join(frames) == expected
+
+
+def test__frames__buffer_reuse():
+    seen_buffers = set()
+    for frame in _get_frames_example().frames(
+        width=32, height=24, buffer_count=3, loglevel='error'
+    ):
+        seen_buffers.add(id(frame))
+    assert len(seen_buffers) == 3
+
+
+def test__frames__numpy():
+    np = pytest.importorskip('numpy')
+    count = 0
+    for frame in _get_frames_example().frames(
+        width=32, height=24, pix_fmt='gray', as_numpy=True, loglevel='error'
+    ):
+        assert frame.shape == (24, 32, 1)
+        assert frame.dtype == np.uint8
+        count += 1
+    assert count == 209
+
+
+def test__frames__probe(mocker):
+    probe__mock = mocker.patch.object(
+        ffmpeg._frames,
+        'probe',
+        return_value={
+            'streams': [
+                {'codec_type': 'audio'},
+                {'codec_type': 'video', 'width': 320, 'height': 240},
+            ]
+        },
+    )
+    frame = next(ffmpeg.input(TEST_INPUT_FILE1).frames(loglevel='error'))
+    assert len(frame) == 320 * 240 * 3
+    probe__mock.assert_called_once_with(TEST_INPUT_FILE1)
+
+    with pytest.raises(ValueError) as excinfo:
+        next(_get_frames_example().frames())
+    assert str(excinfo.value).startswith('`width` and `height` must be specified')
+
+
+def test__frames__error():
+    with pytest.raises(ffmpeg.Error) as excinfo:
+        list(ffmpeg.input(BOGUS_INPUT_FILE).frames(width=32, height=24))
+    assert str(excinfo.value) == 'ffmpeg error (see stderr output for detail)'
+
+
+_shared_frame_buffer = None
+
+
+def _init_shared_frame_worker(buffer):
+    global _shared_frame_buffer
+    _shared_frame_buffer = buffer
+
+
+def _get_shared_frame_sum(index):
+    return sum(bytearray(_shared_frame_buffer.get(index)))
+
+
+def test__frames__shared_buffer():
+    pytest.importorskip('multiprocessing.shared_memory')
+    expected = [
+        sum(bytearray(frame))
+        for frame in _get_frames_example().frames(width=32, height=24, loglevel='error')
+    ]
+    sums = []
+    with ffmpeg.SharedFrameBuffer(32, 24, slot_count=4) as buffer:
+        pool = multiprocessing.Pool(
+            2, initializer=_init_shared_frame_worker, initargs=(buffer,)
+        )
+        try:
+            pending = collections.deque()
+            for index in _get_frames_example().frames(
+                shared_buffer=buffer, loglevel='error'
+            ):
+                assert 0 <= index < 4
+                if len(pending) == len(buffer) - 1:
+                    sums.append(pending.popleft().get())
+                pending.append(pool.apply_async(_get_shared_frame_sum, (index,)))
+            sums += [result.get() for result in pending]
+        finally:
+            pool.terminate()
+            pool.join()
+    assert sums == expected
+
+
+def test__shared_frame_buffer__pickle():
+    pytest.importorskip('multiprocessing.shared_memory')
+    np = pytest.importorskip('numpy')
+    with ffmpeg.SharedFrameBuffer(4, 2, pix_fmt='gray', slot_count=3) as buffer:
+        assert len(buffer) == 3
+        buffer.get(1)[:] = bytes(bytearray(range(8)))
+        copy = pickle.loads(pickle.dumps(buffer))
+        assert copy.name == buffer.name
+        frame = copy.get(1, as_numpy=True)
+        assert frame.shape == (2, 4, 1)
+        assert frame.ravel().tolist() == list(range(8))
+        del frame
+        copy.close()
+        assert buffer.get(1).tobytes() == bytes(bytearray(range(8)))
+
+
+def _get_frame_writer_example(**kwargs):
+    return (
+        ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='8x4')
+        .output('pipe:', format='rawvideo', loglevel='error')
+        .frame_writer(pipe_stdout=True, **kwargs)
+    )
+
+
+def test__frame_writer(mocker):
+    np = pytest.importorskip('numpy')
+    frames = [
+        b'\x01' * 32,
+        bytearray(b'\x02' * 32),
+        memoryview(b'\x03' * 64),
+        np.full((4, 8), 4, dtype=np.uint8),
+        np.full((8, 4), 5, dtype=np.uint8).T,  # not contiguous
+    ]
+    writev = ffmpeg._frames._writev
+    write_counts = []
+
+    def _writev(fd, buffers):
+        write_counts.append(len(buffers))
+        return writev(fd, buffers)
+
+    mocker.patch.object(ffmpeg._frames, '_writev', side_effect=_writev)
+    writer = _get_frame_writer_example(batch_size=96)
+    for frame in frames:
+        writer.write(frame)
+    out, _ = writer.close()
+    assert out == b''.join(
+        bytes(bytearray([value])) * size
+        for value, size in [(1, 32), (2, 32), (3, 64), (4, 32), (5, 32)]
+    )
+    # The two small frames are written together with the large frame in one call;
+    # the rest are batched until the writer is closed.
+    assert write_counts == [2, 1]
+
+
+def test__frame_writer__large_output():
+    # More output than fits in a pipe buffer, which ffmpeg must be able to write
+    # while frames are still being written to its stdin.
+    writer = (
+        ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='64x64')
+        .output('pipe:', format='rawvideo', loglevel='error')
+        .frame_writer(pipe_stdout=True, pipe_stderr=True)
+    )
+    results = []
+
+    def write_frames():
+        for index in range(100):
+            writer.write(bytes(bytearray([index])) * 4096)
+        results.append(writer.close())
+
+    thread = threading.Thread(target=write_frames)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    if thread.is_alive():
+        writer.process.kill()
+    assert len(results) == 1
+    out, err = results[0]
+    assert len(out) == 100 * 4096
+    assert out[-4096:] == bytes(bytearray([99])) * 4096
+    assert err == b''
+
+
+def test__frame_writer__error():
+    writer = (
+        ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='8x4')
+        .output(BOGUS_INPUT_FILE + '/bogus.mp4', loglevel='quiet')
+        .frame_writer()
+    )
+    with pytest.raises(ffmpeg.Error):
+        with writer:
+            for _ in range(100):
+                writer.write(b'\0' * (1024 * 1024))
+
+
+def test__frame_writer__early_exit():
+    writer = (
+        ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='8x4')
+        .output('pipe:', format='rawvideo', vframes=2)
+        .frame_writer(pipe_stdout=True, pipe_stderr=True)
+    )
+    with writer:
+        for _ in range(100):
+            writer.write(b'\0' * (1024 * 1024))
+    out, err = writer.close()
+    assert out == b'\0' * 64
+    assert b'rawvideo' in err
+
+
+def _get_pipeline_output_example():
+    return (
+        ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='32x24')
+        .output(TEST_OUTPUT_FILE1, format='rawvideo', loglevel='error')
+        .overwrite_output()
+    )
+
+
+def test__pipeline():
+    expected, _ = (
+        _get_frames_example()
+        .output('pipe:', format='rawvideo', pix_fmt='gray', an=None)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    thread_ids = set()
+
+    def invert(frame):
+        thread_ids.add(threading.current_thread().ident)
+        time.sleep(random.random() * 0.001)
+        return bytes(bytearray(255 - value for value in bytearray(frame)))
+
+    _get_frames_example().pipeline(
+        invert,
+        _get_pipeline_output_example(),
+        pix_fmt='gray',
+        width=32,
+        height=24,
+        workers=4,
+        loglevel='error',
+    )
+    with open(TEST_OUTPUT_FILE1, 'rb') as f:
+        out = f.read()
+    assert out == bytes(bytearray(255 - value for value in bytearray(expected)))
+    assert len(thread_ids) > 1
+
+
+def test__pipeline__error():
+    def process_frame(frame):
+        raise ValueError('bad frame')
+
+    with pytest.raises(ValueError) as excinfo:
+        _get_frames_example().pipeline(
+            process_frame,
+            _get_pipeline_output_example(),
+            pix_fmt='gray',
+            width=32,
+            height=24,
+            workers=2,
+            loglevel='error',
+        )
+    assert str(excinfo.value) == 'bad frame'
+
+    with pytest.raises(ffmpeg.Error):
+        ffmpeg.input(BOGUS_INPUT_FILE).pipeline(
+            lambda frame: frame,
+            _get_pipeline_output_example(),
+            width=32,
+            height=24,
+            loglevel='quiet',
+        )
+
+
+@pytest.fixture
+def event_loop():
+    asyncio = pytest.importorskip('asyncio')
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test__run_aio(event_loop, mocker):
+    expected, _ = (
+        _get_frames_example()
+        .output('pipe:', format='rawvideo', pix_fmt='gray', an=None)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    remove_file__spy = mocker.spy(ffmpeg._run_asyncio, '_remove_file')
+    out, err = event_loop.run_until_complete(
+        _get_frames_example()
+        .output('pipe:', format='rawvideo', pix_fmt='gray', an=None)
+        .run_aio(capture_stdout=True, capture_stderr=True, filter_complex_script=True)
+    )
+    assert out == expected
+    assert isinstance(err, bytes)
+    for _ in range(10):
+        event_loop.run_until_complete(ffmpeg._run_asyncio.asyncio.sleep(0))
+    assert remove_file__spy.call_count == 1
+    assert not os.path.exists(remove_file__spy.call_args[0][0])
+
+
+def test__run_aio__error(event_loop):
+    with pytest.raises(ffmpeg.Error) as excinfo:
+        event_loop.run_until_complete(
+            ffmpeg.input(BOGUS_INPUT_FILE).output(TEST_OUTPUT_FILE1).run_aio(quiet=True)
+        )
+    assert str(excinfo.value) == 'ffmpeg error (see stderr output for detail)'
+
+
+def test__run_aio__cancel(event_loop, mocker):
+    asyncio = ffmpeg._run_asyncio.asyncio
+    create_subprocess_exec = asyncio.create_subprocess_exec
+    processes = []
+
+    def _create_subprocess_exec(*args, **kwargs):
+        future = asyncio.ensure_future(create_subprocess_exec(*args, **kwargs))
+        future.add_done_callback(lambda f: processes.append(f.result()))
+        return future
+
+    mocker.patch.object(asyncio, 'create_subprocess_exec', new=_create_subprocess_exec)
+    stream = (
+        ffmpeg.input(TEST_INPUT_FILE1, re=None)
+        .output(TEST_OUTPUT_FILE1)
+        .overwrite_output()
+    )
+    start_time = time.time()
+    with pytest.raises(asyncio.TimeoutError):
+        event_loop.run_until_complete(
+            asyncio.wait_for(stream.run_aio(quiet=True), timeout=0.5)
+        )
+    assert time.time() - start_time < 5
+    assert len(processes) == 1
+    assert processes[0].returncode is not None
+
+
+def test__run_aio__threads(event_loop, mocker):
+    asyncio = ffmpeg._run_asyncio.asyncio
+    create_subprocess_exec = asyncio.create_subprocess_exec
+    calls = []
+
+    def _create_subprocess_exec(*args, **kwargs):
+        calls.append((args, kwargs))
+        return create_subprocess_exec(*args, **kwargs)
+
+    mocker.patch.object(asyncio, 'create_subprocess_exec', new=_create_subprocess_exec)
+    stream = ffmpeg.input(TEST_INPUT_FILE1).output('pipe:', format='null', vframes=1)
+    event_loop.run_until_complete(stream.run_aio(quiet=True, threads=2))
+    assert len(calls) == 1
+    args, kwargs = calls[0]
+    assert list(args[:3]) == ['ffmpeg', '-threads', '2']
+    assert kwargs == {
+        'stdin': None,
+        'stdout': subprocess.DEVNULL,
+        'stderr': subprocess.STDOUT,
+        'cwd': None,
+    }
+
+
+def test__run_asyncio(event_loop):
+    stream = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='gray', s='8x4').output(
+        'pipe:', format='rawvideo', loglevel='error'
+    )
+    in_data = bytes(bytearray(range(96)))
+    process = event_loop.run_until_complete(
+        stream.run_asyncio(pipe_stdin=True, pipe_stdout=True)
+    )
+    process.stdin.write(in_data)
+    event_loop.run_until_complete(process.stdin.drain())
+    process.stdin.close()
+    out = event_loop.run_until_complete(process.stdout.read())
+    assert event_loop.run_until_complete(process.wait()) == 0
+    assert out == in_data
+
+
+def _get_async_iter_items(loop, async_iter, count=None):
+    items = []
+    while count is None or len(items) < count:
+        try:
+            items.append(loop.run_until_complete(async_iter.__anext__()))
+        except StopAsyncIteration:
+            break
+    return items
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires python3.6 or higher')
+def test__aframes(event_loop):
+    expected = [
+        frame.tobytes()
+        for frame in _get_frames_example().frames(width=32, height=24, loglevel='error')
+    ]
+    frames = _get_async_iter_items(
+        event_loop,
+        _get_frames_example().aframes(width=32, height=24, loglevel='error'),
+    )
+    assert [frame.tobytes() for frame in frames] == expected
+    assert frames[0].readonly
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires python3.6 or higher')
+def test__aframes__numpy(event_loop):
+    pytest.importorskip('numpy')
+    expected = [
+        frame.tobytes()
+        for frame in _get_frames_example().frames(width=32, height=24, loglevel='error')
+    ]
+    frames = _get_async_iter_items(
+        event_loop,
+        ffmpeg.aframes(
+            _get_frames_example(),
+            pix_fmt='gray',
+            width=32,
+            height=24,
+            as_numpy=True,
+            loglevel='error',
+        ),
+    )
+    assert frames[0].shape == (24, 32, 1)
+    assert len(frames) == len(expected)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires python3.6 or higher')
+def test__aframes__close(event_loop, mocker):
+    kill__spy = mocker.spy(ffmpeg._frames_asyncio.asyncio.subprocess.Process, 'kill')
+    async_iter = _get_frames_example().aframes(width=32, height=24, loglevel='error')
+    assert len(_get_async_iter_items(event_loop, async_iter, count=2)) == 2
+    event_loop.run_until_complete(async_iter.aclose())
+    assert kill__spy.call_count == 1
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='requires python3.6 or higher')
+def test__aframes__error(event_loop):
+    with pytest.raises(ffmpeg.Error) as excinfo:
+        _get_async_iter_items(
+            event_loop, ffmpeg.input(BOGUS_INPUT_FILE).aframes(width=32, height=24)
+        )
+    assert str(excinfo.value) == 'ffmpeg error (see stderr output for detail)'
+
+
+def test__get_args__threads():
+    out = (
+        ffmpeg.input('in.mp4', threads=2)
+        .hflip()
+        .output('out.mp4')
+        .global_args('-filter_threads', '1')
+    )
+    assert out.get_args(threads=4) == [
+        '-threads',
+        '2',
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0]hflip[s0]',
+        '-map',
+        '[s0]',
+        '-threads',
+        '4',
+        'out.mp4',
+        '-filter_threads',
+        '4',
+        '-filter_complex_threads',
+        '4',
+        '-filter_threads',
+        '1',
+    ]
+    assert ffmpeg.input('in.mp4').output('out.mp4').get_args(threads=1) == [
+        '-threads',
+        '1',
+        '-i',
+        'in.mp4',
+        '-threads',
+        '1',
+        'out.mp4',
+        '-filter_threads',
+        '1',
+    ]
+    assert out.get_args() == [
+        '-threads',
+        '2',
+        '-i',
+        'in.mp4',
+        '-filter_complex',
+        '[0]hflip[s0]',
+        '-map',
+        '[s0]',
+        'out.mp4',
+        '-filter_threads',
+        '1',
+    ]
+
+
+def test__get_pool_size():
+    assert ffmpeg._batch._get_pool_size(100, None, None, 8) == (8, 1)
+    assert ffmpeg._batch._get_pool_size(2, None, None, 8) == (2, 4)
+    assert ffmpeg._batch._get_pool_size(100, None, 3, 8) == (2, 3)
+    assert ffmpeg._batch._get_pool_size(100, None, 16, 8) == (1, 16)
+    assert ffmpeg._batch._get_pool_size(100, 3, None, 8) == (3, 2)
+    assert ffmpeg._batch._get_pool_size(100, 3, 5, 8) == (3, 5)
+
+
+def test__run_many():
+    stream_specs = [
+        _get_frames_example().output(
+            'pipe:', format='rawvideo', pix_fmt='gray', an=None, vframes=n
+        )
+        for n in [1, 2, 3]
+    ]
+    stream_specs.insert(1, ffmpeg.input(BOGUS_INPUT_FILE).output('pipe:', f='null'))
+    results = ffmpeg.run_many(
+        stream_specs, max_workers=2, threads_per_job=1, capture_stdout=True
+    )
+    assert [result.returncode == 0 for result in results] == [
+        True,
+        False,
+        True,
+        True,
+    ]
+    assert isinstance(results[1].error, ffmpeg.Error)
+    for result, frame_count in zip([results[0]] + results[2:], [1, 2, 3]):
+        assert result.error is None
+        assert len(result.out) == 32 * 24 * frame_count
+        assert result.wall_time > 0
+        assert result.args[:3] == ['ffmpeg', '-threads', '1']
+    assert ffmpeg.run_many([]) == []
+
+
+def test_cpu_budget():
+    budget = ffmpeg.CpuBudget(8)
+    # A lone caller takes at most half the budget, so a concurrent one can start.
+    assert budget.acquire() == 4
+    assert budget.acquire() == 4
+    budget.release(8)
+    assert ffmpeg.CpuBudget(8, max_threads=8).acquire() == 8
+    assert budget.acquire(share=3) == 2
+    assert budget.acquire(max_threads=4) == 4
+    assert budget.free == 2
+    acquired = []
+    thread = threading.Thread(
+        target=lambda: acquired.append(budget.acquire(3, exact=True))
+    )
+    thread.start()
+    time.sleep(0.1)
+    assert acquired == []
+    budget.release(2)
+    thread.join()
+    assert acquired == [3]
+    assert budget.free == 1
+
+
+def test_cpu_budget__fifo():
+    budget = ffmpeg.CpuBudget(2)
+    assert budget.acquire(max_threads=1) == 1
+    acquired = []
+    exact_thread = threading.Thread(
+        target=lambda: acquired.append(('exact', budget.acquire(2, exact=True)))
+    )
+    exact_thread.daemon = True
+    exact_thread.start()
+    time.sleep(0.1)
+    # A CPU is free, but the exact request is first in line.
+    other_thread = threading.Thread(
+        target=lambda: acquired.append(('other', budget.acquire()))
+    )
+    other_thread.daemon = True
+    other_thread.start()
+    time.sleep(0.1)
+    assert acquired == []
+    budget.release(1)
+    exact_thread.join(5)
+    time.sleep(0.1)
+    assert acquired == [('exact', 2)]
+    budget.release(2)
+    other_thread.join(5)
+    assert acquired == [('exact', 2), ('other', 1)]
+
+
+def test__run__cpu_budget(mocker):
+    popen__mock = mocker.patch.object(ffmpeg._run, '_popen')
+    popen__mock.return_value.communicate.return_value = (None, None)
+    popen__mock.return_value.poll.return_value = 0
+    budget = ffmpeg.CpuBudget(4)
+    stream = ffmpeg.input('in.mp4').output('out.mp4')
+    stream.run(cpu_budget=budget)
+    assert popen__mock.call_args[0][0] == [
+        'ffmpeg',
+        '-threads',
+        '2',
+        '-i',
+        'in.mp4',
+        '-threads',
+        '2',
+        'out.mp4',
+        '-filter_threads',
+        '2',
+    ]
+    stream.run(cpu_budget=budget, threads=2)
+    assert popen__mock.call_args[0][0][1:3] == ['-threads', '2']
+    assert budget.free == 4
+
+
+def test__run_many__cpu_budget():
+    stream_specs = [
+        _get_frames_example().output('pipe:', format='null', vframes=1)
+        for _ in range(3)
+    ]
+    results = ffmpeg.run_many(
+        stream_specs,
+        max_workers=1,
+        cpu_budget=ffmpeg.CpuBudget(4),
+        capture_stdout=True,
+        capture_stderr=True,
+    )
+    assert [result.returncode for result in results] == [0, 0, 0]
+    # Only one job runs at a time, so each one gets all of the CPUs.
+    assert [result.args[2] for result in results] == ['4', '4', '4']
+
+
+def test__get_segment_times():
+    keyframe_times = [0.0, 1.668333, 2.5025, 3.470133, 5.005]
+    get_segment_times = ffmpeg._batch._get_segment_times
+    assert get_segment_times(keyframe_times, 7.04, 1) == [0]
+    assert get_segment_times(keyframe_times, 7.04, 3) == [0, 2.5025, 5.005]
+    assert get_segment_times(keyframe_times, 7.04, 4) == [
+        0,
+        1.668333,
+        3.470133,
+        5.005,
+    ]
+    assert get_segment_times(keyframe_times, 7.04, 100) == [0] + keyframe_times[1:]
+    assert get_segment_times([], 7.04, 4) == [0]
+
+
+def test__parallel_transcode(mocker):
+    probe__mock = mocker.patch.object(
+        ffmpeg._batch,
+        'probe',
+        return_value={
+            'packets': [
+                {'pts_time': '0.000000', 'flags': 'K__'},
+                {'pts_time': '0.033367', 'flags': '___'},
+                {'pts_time': '1.668333', 'flags': 'K__'},
+                {'pts_time': '2.502500', 'flags': 'K__'},
+                {'pts_time': '3.470133', 'flags': 'K__'},
+                {'pts_time': '5.005000', 'flags': 'K__'},
+            ],
+            'format': {'duration': '7.040000'},
+        },
+    )
+    run_many__spy = mocker.spy(ffmpeg._batch, 'run_many')
+    ffmpeg.parallel_transcode(
+        TEST_INPUT_FILE1,
+        TEST_OUTPUT_FILE1,
+        segments=3,
+        overwrite_output=True,
+        vcodec='mpeg4',
+    )
+    probe__mock.assert_called_once_with(
+        TEST_INPUT_FILE1,
+        cmd='ffprobe',
+        select_streams='v:0',
+        show_entries='packet=pts_time,flags',
+    )
+    segment_args = [
+        ffmpeg.get_args(stream_spec)[:6]
+        for stream_spec in run_many__spy.call_args[0][0]
+    ]
+    assert segment_args == [
+        ['-t', '2.5025', '-i', TEST_INPUT_FILE1, '-an', '-vcodec'],
+        ['-ss', '2.5025', '-t', '2.5025', '-i', TEST_INPUT_FILE1],
+        ['-ss', '5.005', '-i', TEST_INPUT_FILE1, '-an', '-vcodec'],
+    ]
+    frame_count = sum(
+        1
+        for _ in ffmpeg.input(TEST_OUTPUT_FILE1).frames(
+            width=320, height=240, pix_fmt='gray', vsync='passthrough', loglevel='error'
+        )
+    )
+    assert frame_count == 209
+    # The audio is copied from the input in one piece.
+    audio_args = {'format': 's16le', 'loglevel': 'error'}
+    expected_audio, _ = (
+        ffmpeg.input(TEST_INPUT_FILE1)
+        .audio.output('pipe:', **audio_args)
+        .run(capture_stdout=True)
+    )
+    audio, _ = (
+        ffmpeg.input(TEST_OUTPUT_FILE1)
+        .audio.output('pipe:', **audio_args)
+        .run(capture_stdout=True)
+    )
+    assert len(audio) > 0
+    assert audio == expected_audio
+
+
+def test__probe__cache(mocker, tmpdir):
+    run_ffprobe__mock = mocker.patch.object(
+        ffmpeg._probe, '_run_ffprobe', return_value='{"format": {"duration": "7"}}'
+    )
+    filename = str(tmpdir.join('in.mp4'))
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * 10)
+    db_path = str(tmpdir.join('probe.db'))
+    cache = ffmpeg.ProbeCache(maxsize=10, path=db_path)
+
+    data = ffmpeg.probe(filename, cache=cache)
+    assert data == {'format': {'duration': '7'}}
+    data['format']['duration'] = '8'
+    assert ffmpeg.probe(filename, cache=cache) == {'format': {'duration': '7'}}
+    assert run_ffprobe__mock.call_count == 1
+    assert cache.info() == (1, 1, 10, 1)
+
+    # Different arguments are cached separately.
+    ffmpeg.probe(filename, cache=cache, select_streams='v')
+    assert run_ffprobe__mock.call_count == 2
+    assert run_ffprobe__mock.call_args[0][0] == [
+        'ffprobe',
+        '-show_format',
+        '-show_streams',
+        '-of',
+        'json',
+        '-select_streams',
+        'v',
+        filename,
+    ]
+
+    # The on-disk store is shared with other caches (and processes).
+    other_cache = ffmpeg.ProbeCache(path=db_path)
+    assert ffmpeg.probe(filename, cache=other_cache) == {'format': {'duration': '7'}}
+    assert run_ffprobe__mock.call_count == 2
+    assert other_cache.info().hits == 1
+
+    # Modifying the file invalidates its entries.
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 1))
+    ffmpeg.probe(filename, cache=cache)
+    assert run_ffprobe__mock.call_count == 3
+    ffmpeg.probe(filename, cache=other_cache)
+    assert run_ffprobe__mock.call_count == 3
+    assert other_cache.info().hits == 2
+
+    # URLs aren't cached.
+    ffmpeg.probe('http://example.com/in.mp4', cache=cache)
+    ffmpeg.probe('http://example.com/in.mp4', cache=cache)
+    assert run_ffprobe__mock.call_count == 5
+
+    cache.clear()
+    assert cache.info() == (0, 0, 10, 0)
+    ffmpeg.probe(filename, cache=ffmpeg.ProbeCache(path=db_path))
+    assert run_ffprobe__mock.call_count == 6
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3), reason='requires python3.3 or higher')
+def test__probe_many__timeout(mocker, tmpdir):
+    fake_ffprobe = tmpdir.join('ffprobe')
+    fake_ffprobe.write('#!{}\nimport time\ntime.sleep(30)\n'.format(sys.executable))
+    fake_ffprobe.chmod(0o755)
+    popen = subprocess.Popen
+    processes = []
+
+    def _popen(*args, **kwargs):
+        process = popen(*args, **kwargs)
+        processes.append(process)
+        return process
+
+    mocker.patch.object(ffmpeg._probe.subprocess, 'Popen', side_effect=_popen)
+    results = list(
+        ffmpeg.probe_many(
+            ['in1.mp4', 'in2.mp4'], cmd=str(fake_ffprobe), max_workers=2, timeout=0.5
+        )
+    )
+    assert [type(result.error) for result in results] == [
+        subprocess.TimeoutExpired,
+        subprocess.TimeoutExpired,
+    ]
+    assert len(processes) == 2
+    assert all(process.returncode is not None for process in processes)
+
+
+def test__probe_many(mocker):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def run_ffprobe(args, timeout):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(random.random() * 0.01)
+        with lock:
+            running[0] -= 1
+        if args[-1] == BOGUS_INPUT_FILE:
+            raise ffmpeg.Error('ffprobe', b'', b'error')
+        return json.dumps({'format': {'filename': args[-1]}})
+
+    mocker.patch.object(ffmpeg._probe, '_run_ffprobe', side_effect=run_ffprobe)
+    filenames = ['{}.mp4'.format(i) for i in range(20)] + [BOGUS_INPUT_FILE]
+    consumed = []
+
+    def get_filenames():
+        for filename in filenames:
+            consumed.append(filename)
+            yield filename
+
+    results = ffmpeg.probe_many(get_filenames(), max_workers=3, timeout=1)
+    first_result = next(results)
+    assert len(consumed) == 4
+    results = [first_result] + list(results)
+    assert sorted(result.filename for result in results) == sorted(filenames)
+    assert max_running[0] <= 3
+    for result in results:
+        if result.filename == BOGUS_INPUT_FILE:
+            assert result.info is None
+            assert isinstance(result.error, ffmpeg.Error)
+            assert result.error.stderr == b'error'
+        else:
+            assert result.info == {'format': {'filename': result.filename}}
+            assert result.error is None
+
+
+def test__probe__entries(mocker):
+    run_ffprobe__mock = mocker.patch.object(
+        ffmpeg._probe,
+        '_run_ffprobe',
+        return_value=json.dumps(
+            {
+                'programs': [],
+                'streams': [
+                    {
+                        'width': 320,
+                        'height': 240,
+                        'r_frame_rate': '30000/1001',
+                        'start_time': '-0.023220',
+                        'tags': {'title': '123'},
+                    }
+                ],
+                'format': {'duration': '7.040000', 'size': '336833'},
+            }
+        ),
+    )
+    data = ffmpeg.probe(
+        TEST_INPUT_FILE1,
+        entries=['stream=width,height,r_frame_rate,start_time', 'format=duration,size'],
+        select_streams='v:0',
+    )
+    run_ffprobe__mock.assert_called_once_with(
+        [
+            'ffprobe',
+            '-show_entries',
+            'stream=width,height,r_frame_rate,start_time:format=duration,size',
+            '-of',
+            'json',
+            '-select_streams',
+            'v:0',
+            TEST_INPUT_FILE1,
+        ],
+        None,
+    )
+    assert data == {
+        'programs': [],
+        'streams': [
+            {
+                'width': 320,
+                'height': 240,
+                'r_frame_rate': '30000/1001',
+                'start_time': -0.02322,
+                'tags': {'title': '123'},
+            }
+        ],
+        'format': {'duration': 7.04, 'size': 336833},
+    }
+
+    ffmpeg.probe(TEST_INPUT_FILE1, entries='format=duration')
+    assert run_ffprobe__mock.call_args[0][0][1:3] == [
+        '-show_entries',
+        'format=duration',
+    ]
+
+
+def test__iter_ffprobe_lines():
+    lines = ffmpeg._probe._iter_ffprobe_lines(
+        [sys.executable, '-c', 'print("a=1|b=2"); print("c=3")']
+    )
+    assert [line.rstrip() for line in lines] == [b'a=1|b=2', b'c=3']
+
+    lines = ffmpeg._probe._iter_ffprobe_lines(
+        [
+            sys.executable,
+            '-c',
+            'import sys; print("a=1"); sys.stderr.write("bad"); sys.exit(1)',
+        ]
+    )
+    assert next(lines).rstrip() == b'a=1'
+    with pytest.raises(ffmpeg.Error) as excinfo:
+        next(lines)
+    assert excinfo.value.stderr == b'bad'
+
+
+_PACKET_LINES = [
+    b'pts_time=0.000000|dts_time=-0.066733|size=9451|pos=48|flags=K__\n',
+    b'pts_time=0.133467|dts_time=-0.033367|size=223|pos=9499|flags=___\n',
+    b'pts_time=N/A|dts_time=0.000000|size=97|pos=N/A|flags=__D\n',
+    b'\n',
+    b'pts_time=1.668333|dts_time=1.601600|size=8000|pos=20000|flags=K__\n',
+]
+
+
+def test__probe_index(mocker):
+    iter_ffprobe_lines__mock = mocker.patch.object(
+        ffmpeg._probe, '_iter_ffprobe_lines', return_value=iter(_PACKET_LINES)
+    )
+    index = ffmpeg.probe_index(TEST_INPUT_FILE1)
+    iter_ffprobe_lines__mock.assert_called_once_with(
+        [
+            'ffprobe',
+            '-v',
+            'error',
+            '-select_streams',
+            'v:0',
+            '-show_entries',
+            'packet=pts_time,dts_time,pos,size,flags',
+            '-of',
+            'compact=print_section=0',
+            TEST_INPUT_FILE1,
+        ]
+    )
+    assert index.pts[:2].tolist() == [0.0, 0.133467]
+    assert math.isnan(index.pts[2])
+    assert index.dts.tolist() == [-0.066733, -0.033367, 0.0, 1.6016]
+    assert index.pos.tolist() == [48, 9499, -1, 20000]
+    assert index.size.tolist() == [9451, 223, 97, 8000]
+    assert index.key.tolist() == [1, 0, 0, 1]
+    assert index.keyframe_times == [0.0, 1.668333]
+
+    iter_ffprobe_lines__mock.return_value = iter(
+        [
+            b'pts_time=0.000000|pkt_dts_time=0.000000|pkt_pos=48|pkt_size=9451|key_frame=1\n',
+            b'pts_time=0.033367|pkt_dts_time=N/A|pkt_pos=9499|pkt_size=223|key_frame=0\n',
+        ]
+    )
+    np = pytest.importorskip('numpy')
+    index = ffmpeg.probe_index(
+        TEST_INPUT_FILE1, stream='v:1', frames=True, as_numpy=True
+    )
+    assert iter_ffprobe_lines__mock.call_args[0][0][4:7] == [
+        'v:1',
+        '-show_entries',
+        'frame=pts_time,pkt_dts_time,pkt_pos,pkt_size,key_frame',
+    ]
+    assert isinstance(index.pts, np.ndarray)
+    assert index.pos.dtype == np.float64
+    assert index.pos.tolist() == [48, 9499]
+    assert index.key.tolist() == [1, 0]
+
+
+def test__probe_index__cache(mocker, tmpdir):
+    iter_ffprobe_lines__mock = mocker.patch.object(
+        ffmpeg._probe, '_iter_ffprobe_lines', side_effect=lambda args: _PACKET_LINES
+    )
+    db_path = str(tmpdir.join('probe.db'))
+    index = ffmpeg.probe_index(TEST_INPUT_FILE1, cache=ffmpeg.ProbeCache(path=db_path))
+    cached_index = ffmpeg.probe_index(
+        TEST_INPUT_FILE1, cache=ffmpeg.ProbeCache(path=db_path)
+    )
+    assert iter_ffprobe_lines__mock.call_count == 1
+    assert cached_index.pos == index.pos
+    assert cached_index.key == index.key
+    assert cached_index.dts == index.dts
+
+
+_PROBE_JSON = '''{
+    "packets": [
+        {
+            "codec_type": "video",
+            "pts_time": "0.000000",
+            "flags": "K__"
+        },
+        {
+            "codec_type": "video",
+            "pts_time": "0.033367",
+            "flags": "___"
+        }
+    ],
+    "programs": [
+
+    ],
+    "streams": [
+        {
+            "index": 0,
+            "tags": {
+                "title": "caf\\u00e9 \u2603 [x]"
+            }
+        }
+    ],
+    "format": {
+        "duration": "7.040000"
+    }
+}
+'''
+
+
+def test__iter_json_records():
+    data = _PROBE_JSON.encode('utf-8')
+    for chunk_size in [1, 7, 64, len(data)]:
+        chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+        records = list(ffmpeg._probe._iter_json_records(chunks))
+        expected = json.loads(_PROBE_JSON)
+        assert records == [
+            ('packets', expected['packets'][0]),
+            ('packets', expected['packets'][1]),
+            ('streams', expected['streams'][0]),
+            ('format', expected['format']),
+        ]
+
+    with pytest.raises(ValueError):
+        list(ffmpeg._probe._iter_json_records([data[:-10]]))
+
+
+def test__iter_json_records__large_record(mocker):
+    decode_count = [0]
+    base_decoder = json.JSONDecoder
+
+    class JSONDecoder(base_decoder):
+        def raw_decode(self, *args, **kwargs):
+            decode_count[0] += 1
+            return base_decoder.raw_decode(self, *args, **kwargs)
+
+    tags = {'tag{}'.format(i): 'x' * 100 for i in range(10000)}
+    data = json.dumps({'format': {'tags': tags}}).encode('utf-8')
+    chunks = [data[i : i + 1024] for i in range(0, len(data), 1024)]
+    mocker.patch.object(ffmpeg._probe.json, 'JSONDecoder', JSONDecoder)
+    records = list(ffmpeg._probe._iter_json_records(chunks))
+    assert records == [('format', {'tags': tags})]
+    # The record spans about 1000 chunks, but is only re-parsed as the amount of
+    # buffered data doubles.
+    assert decode_count[0] < 30
+
+
+def test__probe_iter(mocker):
+    iter_ffprobe_chunks__mock = mocker.patch.object(
+        ffmpeg._probe,
+        '_iter_ffprobe_chunks',
+        return_value=iter([_PROBE_JSON.encode('utf-8')]),
+    )
+    records = ffmpeg.probe_iter(
+        TEST_INPUT_FILE1,
+        entries=['packet=pts_time,flags', 'format=duration'],
+        show_streams=None,
+        chunk_size=1024,
+    )
+    assert [section for section, _ in records] == [
+        'packets',
+        'packets',
+        'streams',
+        'format',
+    ]
+    iter_ffprobe_chunks__mock.assert_called_once_with(
+        [
+            'ffprobe',
+            '-show_entries',
+            'packet=pts_time,flags:format=duration',
+            '-of',
+            'json',
+            '-show_streams',
+            TEST_INPUT_FILE1,
+        ],
+        1024,
+    )
+
+    iter_ffprobe_chunks__mock.return_value = iter([_PROBE_JSON.encode('utf-8')])
+    records = list(ffmpeg.probe_iter(TEST_INPUT_FILE1, entries='format=duration'))
+    assert records[-1] == ('format', {'duration': 7.04})
+
+
+def test__iter_ffprobe_chunks():
+    # Write ASCII-only JSON, since python 2's stdout can't encode other characters.
+    script = 'import sys; sys.stdout.write({!r}); sys.exit(1)'.format(
+        json.dumps(json.loads(_PROBE_JSON), indent=4, sort_keys=True)
+    )
+    records = ffmpeg._probe._iter_json_records(
+        ffmpeg._probe._iter_ffprobe_chunks([sys.executable, '-c', script], 16)
+    )
+    assert next(records)[0] == 'format'
+    with pytest.raises(ffmpeg.Error):
+        list(records)